@@ -6,19 +6,41 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 #
 
+# The server is in ged2dot_server.py, the rest is kept in one file.
+# pylint: disable=too-many-lines
+
 import time
 import os
 import sys
+import array
 import configparser
+import bisect
 import codecs
-from functools import cmp_to_key
+import collections
+import concurrent.futures
+import fnmatch
+import hashlib
+import heapq
+import html
+import io
+import json
+import mmap
+import pickle
+import re
+import tempfile
+import unicodedata
+import xml.sax.saxutils
 from typing import Any
 from typing import BinaryIO
 from typing import Dict
+from typing import Iterator
 from typing import List
+from typing import NamedTuple
 from typing import Optional
+from typing import Set
 from typing import TextIO
 from typing import Tuple
+from typing import Union
 from typing import cast
 
 
@@ -40,19 +62,34 @@ class NoSuchIndividualException(Exception):
     pass
 
 
+class GedcomParseError(ValueError):
+    pass
+
+
 # Model
 
+# Size of pictures in node labels.
+THUMBNAIL_SIZE = (100, 100)
+
+# Not yet resolved individuals and families as plain tuples, see Model.get_records().
+Records = Tuple[List[Tuple[Any, ...]], List[Tuple[Any, ...]]]
+
+
 class Individual:
     placeholderDir = os.path.dirname(os.path.realpath(__file__))
     """An individual is our basic building block, can be part of multiple families (usually two)."""
+    # Large trees have lots of these, so avoid a per-instance dict.
+    __slots__ = ("model", "iid", "sex", "forename", "surname", "_famc", "_fams", "birt", "deat")
+
     def __init__(self, model: 'Model') -> None:
         self.model = model
         self.iid = ""
         self.sex = None  # type: Optional[str]
         self.forename = ""  # John
         self.surname = ""  # Smith
-        self.famc = None  # type: Any  # str or Family
-        self.fams = None  # type: Any  # str or Family
+        # The family reference is a string till it's resolved.
+        self._famc = None  # type: Union[str, Family, None]
+        self._fams = None  # type: Union[str, Family, None]
         self.birt = ""
         self.deat = ""
         # Horizontal order is ensured by order deps. Any order dep starting from this node?
@@ -61,17 +98,42 @@ class Individual:
     def __str__(self) -> str:
         return "iid: %s, sex: %s, forename: %s, surname: %s: famc: %s, fams: %s, birt: %s, deat: %s" % (self.iid, self.sex, self.forename, self.surname, self.famc, self.fams, self.birt, self.deat)
 
+    @property
+    def famc(self) -> Any:
+        """The family reference string is replaced with the object on first access."""
+        if isinstance(self._famc, str):
+            self._famc = self.model.get_family(self._famc)
+        return self._famc
+
+    @famc.setter
+    def famc(self, famc: Any) -> None:
+        self._famc = famc
+
+    @property
+    def fams(self) -> Any:
+        """Same as famc."""
+        if isinstance(self._fams, str):
+            self._fams = self.model.get_family(self._fams)
+        return self._fams
+
+    @fams.setter
+    def fams(self, fams: Any) -> None:
+        self._fams = fams
+
     def resolve(self) -> None:
         """Replaces family reference strings with references to objects."""
-        self.famc = self.model.get_family(self.famc)
-        self.fams = self.model.get_family(self.fams)
+        # The getters do the actual work.
+        self.famc = self.famc
+        self.fams = self.fams
 
     def get_full_name(self) -> str:
         """Full name of the individual. Only used as comments in the output
         file to ease debugging."""
         return "%s %s" % (self.forename, self.surname)
 
-    def get_label(self) -> str:
+    def get_names(self) -> Tuple[str, str]:
+        """Forename and surname, converted according to imageFormatCase."""
+        templates = self.model.templates
         if self.forename:
             forename = self.forename
         else:
@@ -81,58 +143,67 @@ class Individual:
         else:
             surname = ""
 
-        if self.model.config.imageFormatCase.lower() == 'lower':
+        if templates.image_format_case == 'lower':
             forename = forename.lower()
             surname = surname.lower()
-        elif self.model.config.imageFormatCase.lower() == 'upper':
+        elif templates.image_format_case == 'upper':
             forename = forename.upper()
             surname = surname.upper()
-
-        path = self.model.config.imageFormat % {
+        return forename, surname
+
+    def get_picture_path(self) -> str:
+        """Path of the picture of the individual, it may not exist."""
+        templates = self.model.templates
+        forename, surname = self.get_names()
+        gw_index = 0
+        if templates.uses_gw_index:
+            gw_index = self.model.get_individual_gene_web_index(self.iid, self.forename, self.surname)
+        path = templates.image_format % {
             'forename': forename,
             'surname': surname,
-            'gwIndex': self.model.get_individual_gene_web_index(self.iid, self.forename, self.surname),
+            'gwIndex': gw_index,
             'birt': self.birt
         }
 
-        if self.model.config.imageFormatGeneweb:
-            import unicodedata
+        if templates.image_format_geneweb:
             path = unicodedata.normalize('NFKD', path).encode('ascii', 'ignore').decode('ascii')
             path = path.translate(dict({ord("-"): "_"}))
 
         try:
-            fullpath = os.path.join(self.model.basedir, path)
+            return os.path.join(self.model.basedir, path)
         except (UnicodeDecodeError) as ude:
             sys.stderr.write("Wrong encoding? %s\n" % str(ude))
-            fullpath = ""
-        if os.path.exists(fullpath) and not self.model.config.anonMode:
-            picture = fullpath
+            return ""
+
+    def get_label_picture(self) -> str:
+        """The picture of the label before scaling: the picture of the
+        individual if it exists, a placeholder otherwise."""
+        fullpath = self.get_picture_path()
+        if os.path.exists(fullpath) and not self.model.templates.anon_mode:
+            return fullpath
+        if self.sex:
+            sex = self.sex.lower()
         else:
-            if self.sex:
-                sex = self.sex.lower()
-            else:
-                sex = 'u'
-            picture = os.path.join(Individual.placeholderDir, "placeholder-%s.png" % sex)
+            sex = 'u'
+        return os.path.join(Individual.placeholderDir, "placeholder-%s.png" % sex)
+
+    def get_shown_picture(self) -> str:
+        """The picture of the label, scaled to THUMBNAIL_SIZE."""
+        picture = self.get_label_picture()
+        # Each picture is only checked once, placeholders are shared by lots of nodes.
+        shown_picture = self.model.pictures.get(picture)
+        if shown_picture is None:
+            shown_picture = self.__get_shown_picture(picture)
+            self.model.pictures[picture] = shown_picture
+        return shown_picture
 
-        try:
-            from PIL import Image  # type: ignore  # No library stub file for module
-            i = Image.open(picture)
-            if i.size != (100, 100):
-                picture = "%s.tumbnail.png" % picture
-                if not os.path.exists(picture):
-                    sys.stderr.write("// Scaling picture of %s as it didn't have 100x100 px\n" % self.get_full_name())
-                    i.thumbnail((100, 100), Image.ANTIALIAS)
-                    i.save(picture, "PNG")
-            i.close()
-        except ImportError:
-            pass
+    def get_label(self) -> str:
+        templates = self.model.templates
+        forename, surname = self.get_names()
+        picture = self.get_shown_picture()
 
-        format_string = ""
-        if self.model.config.images:
-            format_string = self.model.config.nodeLabelImage
-        else:
-            format_string = self.model.config.nodeLabelPlain
-        if self.model.config.anonMode:
+        format_string = templates.node_label
+        if templates.anon_mode:
             birt = self.birt
             if len(birt) > 1:
                 birt = "YYYY"
@@ -154,6 +225,29 @@ class Individual:
             'deat': self.deat
         }
 
+    def __get_shown_picture(self, picture: str) -> str:
+        """Returns the path of picture, scaled to THUMBNAIL_SIZE."""
+        if self.model.thumbnail_cache:
+            return self.model.thumbnail_cache.get_picture(picture, self.get_full_name())
+
+        try:
+            from PIL import Image  # type: ignore  # No library stub file for module
+            i = Image.open(picture)
+            if i.size != THUMBNAIL_SIZE:
+                picture = "%s.tumbnail.png" % picture
+                if not os.path.exists(picture):
+                    sys.stderr.write("// Scaling picture of %s as it didn't have 100x100 px\n" % self.get_full_name())
+                    i.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+                    # Write to a temporary file first, batch workers may scale the same picture.
+                    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(picture), suffix=".png")
+                    with os.fdopen(handle, "wb") as stream:
+                        i.save(stream, "PNG")
+                    os.replace(temp_path, picture)
+            i.close()
+        except ImportError:
+            pass
+        return picture
+
     def get_color(self) -> str:
         if self.sex is None:
             sex = 'U'
@@ -162,7 +256,10 @@ class Individual:
         return {'M': 'blue', 'F': 'pink', 'U': 'black'}[sex]
 
     def get_node(self) -> 'Node':
-        return Node(self.iid, '[ shape = box,\nlabel = %s,\ncolor = %s,\npenwidth=%s ]' % (self.get_label(), self.get_color(), self.model.config.nodeBorderWidth))
+        label = self.model.labels.get(self)
+        if label is None:
+            label = self.get_label()
+        return Node(self.iid, self.model.templates.node_rest % (label, self.get_color()))
 
     def set_birt(self, birt: str) -> None:
         if not birt:
@@ -178,59 +275,85 @@ class Individual:
 
 class Family:
     """Family has exactly one wife and husb, 0..* children."""
-    phCount = 0
+    __slots__ = ("model", "fid", "_husb", "_wife", "chil", "depth")
 
     def __init__(self, model: 'Model') -> None:
         self.model = model
         self.fid = None  # type: Optional[str]
-        self.husb = None  # type: Any  # str or Individual
-        self.wife = None  # type: Any  # str or Individual
+        # The individual reference is a string till it's resolved.
+        self._husb = None  # type: Union[str, Individual, None]
+        self._wife = None  # type: Union[str, Individual, None]
         self.chil = []  # type: List[str]
         self.depth = 0
 
     def __str__(self) -> str:
         return "fid: %s, husb: %s, wife: %s, chil: %s, depth: %s" % (self.fid, self.husb, self.wife, self.chil, self.depth)
 
+    @property
+    def husb(self) -> Any:
+        """The individual reference string is replaced with the object on first access."""
+        if isinstance(self._husb, str):
+            self._husb = self.model.get_individual(self._husb)
+        return self._husb
+
+    @husb.setter
+    def husb(self, husb: Any) -> None:
+        self._husb = husb
+
+    @property
+    def wife(self) -> Any:
+        """Same as husb."""
+        if isinstance(self._wife, str):
+            self._wife = self.model.get_individual(self._wife)
+        return self._wife
+
+    @wife.setter
+    def wife(self, wife: Any) -> None:
+        self._wife = wife
+
     def resolve(self) -> None:
         """Replaces individual reference strings with references to objects."""
-        self.husb = self.model.get_individual(self.husb)
-        self.wife = self.model.get_individual(self.wife)
+        # The getters do the actual work.
+        self.husb = self.husb
+        self.wife = self.wife
 
-    def sort_children(self, filtered_families: List['Family']) -> None:
+    def sort_children(self, filtered_families: Dict['Family', None]) -> None:
         """Sort children, based on filtered families of the layout."""
-        def compare_children(x_str: str, y_str: str) -> int:
-            # For now just try to produce a traditional "husb left, wife right"
-            # order, ignore birth date.
-            x_obj = self.model.get_individual(x_str)
-            if not x_obj:
-                raise NoSuchIndividualException("Can't find individual '%s' in the input file." % x_str)
-
-            y_obj = self.model.get_individual(y_str)
-            if not y_obj:
-                raise NoSuchIndividualException("Can't find individual '%s' in the input file." % y_str)
-
-            if x_obj.sex == "M" and x_obj.fams and self.model.get_family(x_obj.fams.fid, filtered_families):
-                return 1
-            if y_obj.sex == "M" and y_obj.fams and self.model.get_family(y_obj.fams.fid, filtered_families):
-                return -1
-            if x_obj.sex == "F" and x_obj.fams and self.model.get_family(x_obj.fams.fid, filtered_families):
-                return -1
-            if y_obj.sex == "F" and y_obj.fams and self.model.get_family(y_obj.fams.fid, filtered_families):
-                return 1
-            return 0
-        self.chil.sort(key=cmp_to_key(compare_children))
+        by_birth = self.model.config.childOrderBirth
+
+        def child_key(chil: str) -> Tuple[int, int, int]:
+            # Produce a traditional "husb left, wife right" order: a wife who
+            # is shown goes first, a husb who is shown goes last.
+            individual = self.model.get_individual(chil)
+            if not individual:
+                raise NoSuchIndividualException("Can't find individual '%s' in the input file." % chil)
+
+            rank = 1
+            if individual.fams in filtered_families:
+                if individual.sex == "M":
+                    rank = 2
+                elif individual.sex == "F":
+                    rank = 0
+            if by_birth and individual.birt.isdigit():
+                return (rank, 0, int(individual.birt))
+            # Unknown birth goes after known ones, the sort is stable.
+            return (rank, 1, 0)
+        # Always start from the input order, so the result doesn't depend on
+        # previous layouts of the same model.
+        chil_order = self.model.chil_orders.setdefault(self, self.chil)
+        self.chil = sorted(chil_order, key=child_key)
 
     def get_husb(self) -> Individual:
         """Same as accessing 'husb' directly, except that in case that would be
         None, a placeholder individual is created."""
         if not self.husb:
             self.husb = Individual(self.model)
-            self.husb.iid = "PH%d" % Family.phCount
-            Family.phCount += 1
+            self.husb.iid = "PH%d" % len(self.model.placeholders)
             self.husb.sex = 'M'
             self.husb.forename = "?"
             self.husb.surname = ""
-            self.model.individuals.append(self.husb)
+            self.model.add_individual(self.husb)
+            self.model.placeholders.append((self, self.husb))
         assert isinstance(self.husb, Individual)
         return self.husb
 
@@ -238,63 +361,392 @@ class Family:
         """Same as get_husb(), but for wifes."""
         if not self.wife:
             self.wife = Individual(self.model)
-            self.wife.iid = "PH%d" % Family.phCount
-            Family.phCount += 1
+            self.wife.iid = "PH%d" % len(self.model.placeholders)
             self.wife.sex = 'F'
             self.wife.forename = "?"
             self.wife.surname = ""
-            self.model.individuals.append(self.wife)
+            self.model.add_individual(self.wife)
+            self.model.placeholders.append((self, self.wife))
         assert isinstance(self.wife, Individual)
         return self.wife
 
 
+class Templates:
+    """Options used for each node or edge, evaluated only once."""
+    # The options the templates are made of.
+    options = ("imageFormat", "imageFormatCase", "imageFormatGeneweb", "anonMode", "images", "nodeLabelImage",
+               "nodeLabelPlain", "nodeBorderWidth", "edgeInvisibleRed", "edgeVisibleDirected")
+
+    def __init__(self, config: 'Config') -> None:
+        self.key = Templates.get_key(config)
+        self.image_format = config.imageFormat  # type: str
+        self.image_format_case = config.imageFormatCase.lower()  # type: str
+        self.uses_gw_index = "gwIndex" in config.imageFormat
+        self.image_format_geneweb = config.imageFormatGeneweb  # type: bool
+        self.anon_mode = config.anonMode  # type: bool
+        if config.images:
+            self.node_label = config.nodeLabelImage  # type: str
+        else:
+            self.node_label = config.nodeLabelPlain
+        # Label and color are still to be substituted.
+        self.node_rest = '[ shape = box,\nlabel = %s,\ncolor = %s,\npenwidth=' + config.nodeBorderWidth.replace('%', '%%') + ' ]'
+        if config.edgeInvisibleRed:
+            self.edge_invisible = "[ color = red ]"
+        else:
+            self.edge_invisible = "[ style = invis ]"
+        if config.edgeVisibleDirected:
+            self.edge_visible = ""
+        else:
+            self.edge_visible = "[ arrowhead = none ]"
+
+    @staticmethod
+    def get_key(config: 'Config') -> Tuple[Any, ...]:
+        return tuple(config.option[i] for i in Templates.options)
+
+    def is_current(self, config: 'Config') -> bool:
+        """Returns if the templates are still the ones of config, in case its
+        options were changed, e.g. by Model.save_with()."""
+        return self.key == Templates.get_key(config)
+
+
 class Model:
     def __init__(self, config: 'Config') -> None:
         self.config = config
+        self.templates = Templates(config)
+        # Picture path -> path of the picture shown in the label.
+        self.pictures = {}  # type: Dict[str, str]
         # List of all individuals.
         self.individuals = []  # type: List[Individual]
         # List of all families.
         self.families = []  # type: List[Family]
+        # Maps from IDs to individuals and families, to avoid linear search.
+        self.individual_index = {}  # type: Dict[str, Individual]
+        self.family_index = {}  # type: Dict[str, Family]
+        self.thumbnail_cache = None  # type: Optional[ThumbnailCache]
+        if config.thumbnailCacheDir:
+            self.thumbnail_cache = ThumbnailCache(config)
+        # Maps from (forename, surname) to sorted individual IDs, built on first use.
+        self.name_index = None  # type: Optional[Dict[Tuple[str, str], List[str]]]
         self.basedir = ""
+        # In case of lazy loading: the mapped input and the not yet parsed
+        # records, as an ID -> (start offset, end offset, line number) map.
+        self.mapped = None  # type: Optional[mmap.mmap]
+        self.record_index = {}  # type: Dict[str, Tuple[int, int, int]]
+        # ID -> hash of the record, in case changes of the input are tracked.
+        self.record_hashes = None  # type: Optional[Dict[str, bytes]]
+        # Placeholder individuals created for missing husbands and wifes, and their families.
+        self.placeholders = []  # type: List[Tuple[Family, Individual]]
+        # Results of Individual.get_label(), in case they were prepared in advance.
+        self.labels = {}  # type: Dict[Individual, str]
+        # Order of Family.chil in the input, for the sorted families.
+        self.chil_orders = {}  # type: Dict[Family, List[str]]
+
+    def __clear(self) -> None:
+        """Forgets all individuals and families."""
+        self.individuals = []
+        self.families = []
+        self.individual_index = {}
+        self.family_index = {}
+        self.name_index = None
+        self.mapped = None
+        self.record_index = {}
+        self.record_hashes = None
+        self.placeholders = []
+        self.labels = {}
+        self.chil_orders = {}
+
+    def add_individual(self, individual: Individual) -> None:
+        self.individuals.append(individual)
+        # In case of duplicated IDs, the first one wins.
+        self.individual_index.setdefault(individual.iid, individual)
+        if self.name_index is not None:
+            bisect.insort(self.name_index.setdefault((individual.forename, individual.surname), []), individual.iid)
+
+    def add_family(self, family: Family) -> None:
+        self.families.append(family)
+        if family.fid is not None:
+            self.family_index.setdefault(family.fid, family)
+
+    def get_records(self) -> Records:
+        """Returns the individuals and families as plain tuples, with
+        references as IDs, even if they are resolved already."""
+        def family_id(family: Any) -> Optional[str]:
+            if isinstance(family, Family):
+                return family.fid
+            return cast(Optional[str], family)
+
+        def individual_id(individual: Any) -> Optional[str]:
+            if isinstance(individual, Individual):
+                return individual.iid
+            return cast(Optional[str], individual)
+
+        individuals = [(i.iid, i.sex, i.forename, i.surname, family_id(i._famc), family_id(i._fams), i.birt, i.deat) for i in self.individuals]
+        families = [(i.fid, individual_id(i._husb), individual_id(i._wife), self.chil_orders.get(i, i.chil)) for i in self.families]
+        return individuals, families
+
+    def add_records(self, records: Records) -> None:
+        """Adds individuals and families, as returned by get_records()."""
+        individuals, families = records
+        for iid, sex, forename, surname, famc, fams, birt, deat in individuals:
+            individual = Individual(self)
+            individual.iid = iid
+            individual.sex = sex
+            individual.forename = forename
+            individual.surname = surname
+            individual.famc = famc
+            individual.fams = fams
+            individual.birt = birt
+            individual.deat = deat
+            self.add_individual(individual)
+        for fid, husb, wife, chil in families:
+            family = Family(self)
+            family.fid = fid
+            family.husb = husb
+            family.wife = wife
+            family.chil = chil
+            self.add_family(family)
 
     def get_individual(self, id_string: str) -> Optional[Individual]:
+        if self.record_index and id_string not in self.individual_index:
+            self.load_record(id_string)
+        return self.individual_index.get(id_string)
+
+    def build_name_index(self) -> None:
+        # This needs all individuals with the same name.
+        self.__load_all()
+        name_index = {}  # type: Dict[Tuple[str, str], List[str]]
         for i in self.individuals:
-            if i.iid == id_string:
-                return i
-        return None
+            name_index.setdefault((i.forename, i.surname), []).append(i.iid)
+        for iids in name_index.values():
+            iids.sort()
+        self.name_index = name_index
 
     def get_individual_gene_web_index(self, search_id: str, forename: str, surname: str) -> int:
-        my_list = []
-        for i in self.individuals:
-            if (i.forename == forename) and (i.surname == surname):
-                my_list.append(i.iid)
-        my_list.sort()
-        return my_list.index(search_id)
+        if self.name_index is None:
+            self.build_name_index()
+        assert self.name_index is not None
+        iids = self.name_index.get((forename, surname), [])
+        pos = bisect.bisect_left(iids, search_id)
+        if pos == len(iids) or iids[pos] != search_id:
+            raise ValueError("'%s' is not an individual named '%s %s'" % (search_id, forename, surname))
+        return pos
 
     def get_family(self, id_string: str, family_set: Optional[List[Family]] = None) -> Optional[Family]:
-        if family_set:
-            families = family_set
-        else:
-            families = self.families
-        for i in families:
+        if not family_set:
+            if self.record_index and id_string not in self.family_index:
+                self.load_record(id_string)
+            return self.family_index.get(id_string)
+        for i in family_set:
             if i.fid == id_string:
                 return i
         return None
 
     def load(self, name: str) -> None:
         self.basedir = os.path.dirname(name)
-        inf = open(name, "rb")
-        GedcomImport(inf, self).load()
-        inf.close()
+        if self.config.lazyLoad:
+            self.__index_records(name)
+            return
+        cache = None
+        if self.config.modelCacheDir:
+            cache = ModelCache(self.config)
+        if not cache or not cache.load(name, self):
+            if self.config.parseJobs > 1:
+                self.__load_parallel(name)
+            else:
+                with open(name, "rb") as inf:
+                    GedcomImport(inf, self).load()
+            if cache:
+                cache.save(name, self)
+        self.resolve()
+
+    def __hash_records(self, name: str) -> Tuple[Dict[str, Tuple[int, int, int]], Dict[str, bytes]]:
+        """Hashes the records of name, mapping it instead of reading it.
+        Returns the ID -> (start offset, end offset, line number) index and
+        the ID -> hash map of the records."""
+        with open(name, "rb") as inf:
+            try:
+                mapped = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty input.
+                return {}, {}
+        with mapped:
+            index = GedcomIndex(name, self.config.inputEncoding)
+            index.build(mapped, with_surnames=False)
+            hashes = {}  # type: Dict[str, bytes]
+            for id_string, (start, end, _linecount) in index.records.items():
+                hashes[id_string] = hashlib.sha1(mapped[start:end]).digest()
+        return index.records, hashes
+
+    def track_changes(self, name: str) -> None:
+        """Remembers the records of name, so reload() can parse only the
+        changed ones."""
+        _records, self.record_hashes = self.__hash_records(name)
+
+    def reload(self, name: str) -> Tuple[Set[str], Set[str]]:
+        """Updates the model after name changed. In case track_changes() was
+        called, only the new and changed records are parsed, and the model is
+        not changed if that raises GedcomParseError. Returns the IDs of the
+        added, changed and removed individuals and families."""
+        if self.record_hashes is None or self.config.lazyLoad:
+            individuals = set(self.individual_index)
+            families = set(self.family_index)
+            self.__clear()
+            self.load(name)
+            if not self.config.lazyLoad:
+                self.track_changes(name)
+            return individuals | set(self.individual_index), families | set(self.family_index)
+
+        records, hashes = self.__hash_records(name)
+        changed = {i for i, digest in hashes.items() if self.record_hashes.get(i) != digest}
+        stale = changed | (set(self.record_hashes) - set(hashes))
+        if not stale:
+            self.record_hashes = hashes
+            return set(), set()
+
+        # Parse the changed records first, so the model is left as it was in
+        # case that fails, and they are parsed again on the next reload.
+        parsed = []  # type: List[Union[Individual, Family]]
+        with open(name, "rb") as inf:
+            for id_string in sorted(changed, key=lambda i: records[i][0]):
+                start, end, linecount = records[id_string]
+                inf.seek(start)
+                parsed.extend(GedcomImport(io.BytesIO(inf.read(end - start)), self, linecount).parse())
+        self.record_hashes = hashes
+        individuals = {i for i in stale if i in self.individual_index}
+        families = {i for i in stale if i in self.family_index}
+
+        # Placeholders of replaced families would be left behind, they are
+        # created again when needed, as if everything was parsed again.
+        self.__drop_placeholders()
+        self.individuals = [i for i in self.individuals if i.iid not in stale]
+        self.families = [i for i in self.families if i.fid not in stale]
+        self.labels = {key: value for key, value in self.labels.items() if key.iid not in stale}
+        self.chil_orders = {key: value for key, value in self.chil_orders.items() if key.fid not in stale}
+        for id_string in stale:
+            self.individual_index.pop(id_string, None)
+            self.family_index.pop(id_string, None)
+        for record in parsed:
+            if isinstance(record, Individual):
+                self.add_individual(record)
+            else:
+                self.add_family(record)
+        individuals |= {i for i in changed if i in self.individual_index}
+        families |= {i for i in changed if i in self.family_index}
+
+        # Keep the order of the input, as if everything was parsed again.
+        self.individuals.sort(key=lambda i: records[i.iid][0] if i.iid in records else sys.maxsize)
+        self.families.sort(key=lambda i: records[i.fid][0] if i.fid in records else sys.maxsize)
+
+        # References to the old objects are resolved again.
+        for individual in self.individuals:
+            if isinstance(individual._famc, Family) and individual._famc.fid in families:
+                individual._famc = individual._famc.fid
+            if isinstance(individual._fams, Family) and individual._fams.fid in families:
+                individual._fams = individual._fams.fid
+        for family in self.families:
+            if isinstance(family._husb, Individual) and family._husb.iid in individuals:
+                family._husb = family._husb.iid
+            if isinstance(family._wife, Individual) and family._wife.iid in individuals:
+                family._wife = family._wife.iid
+        self.resolve()
+
+        if individuals and self.templates.uses_gw_index:
+            # Labels depend on other individuals with the same name.
+            self.name_index = None
+            self.labels = {}
+        return individuals, families
+
+    def resolve(self) -> None:
+        """Replaces reference strings with references to objects."""
         for individual in self.individuals:
             individual.resolve()
         for family in self.families:
             family.resolve()
 
-    def save(self, out: Optional[TextIO]) -> None:
+    @staticmethod
+    def split_input(mapped: Union[bytes, mmap.mmap], count: int) -> List[Tuple[int, int, int]]:
+        """Splits the input into count chunks of about the same size at level 0
+        lines. Returns a list of start offset, end offset, line number
+        tuples."""
+        size = len(mapped)
+        boundaries = [0]
+        for i in range(1, count):
+            pos = mapped.find(b"\n0 ", max(size * i // count, boundaries[-1]))
+            if pos == -1:
+                break
+            boundaries.append(pos + 1)
+        boundaries.append(size)
+        chunks = []
+        linecount = 1
+        for start, end in zip(boundaries, boundaries[1:]):
+            chunks.append((start, end, linecount))
+            linecount += mapped[start:end].count(b"\n")
+        return chunks
+
+    def __load_parallel(self, name: str) -> None:
+        """Parses chunks of the input in parallel, using parseJobs processes."""
+        with open(name, "rb") as inf:
+            try:
+                mapped = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty input.
+                return
+        with mapped:
+            chunks = self.split_input(mapped, self.config.parseJobs)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.config.parseJobs) as executor:
+            futures = [executor.submit(parse_chunk, self.config.config_dict, name, start, end, linecount) for start, end, linecount in chunks]
+            # Keep the order of the input.
+            for future in futures:
+                self.add_records(future.result())
+
+    def __index_records(self, name: str) -> None:
+        """Finds the individuals and families of the input without parsing
+        them, so get_individual() and get_family() can do that on demand."""
+        with open(name, "rb") as inf:
+            try:
+                self.mapped = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty input.
+                return
+        index = GedcomIndex(name, self.config.inputEncoding)
+        if not self.config.inputIndex or not index.read():
+            index.build(self.mapped)
+            if self.config.inputIndex:
+                index.write()
+        self.record_index = dict(index.records)
+
+    def load_record(self, id_string: str) -> None:
+        """Parses a single record, in case of lazy loading."""
+        entry = self.record_index.pop(id_string, None)
+        if not entry or not self.mapped:
+            return
+        start, end, linecount = entry
+        GedcomImport(io.BytesIO(self.mapped[start:end]), self, linecount).load()
+
+    def __load_all(self) -> None:
+        """Parses all not yet parsed records, in case of lazy loading."""
+        # In the order of the input, dicts are not ordered before Python 3.6.
+        for id_string in sorted(self.record_index, key=lambda i: self.record_index[i][0]):
+            self.load_record(id_string)
+
+    def save(self, out: Optional[TextIO]) -> 'Layout':
         """Save is done by calcularing and rendering the layout on the output."""
+        # Layouts may reduce the depths for this save, restore them.
+        saved = dict(self.config.option)
+        try:
+            return self.__save(out)
+        finally:
+            self.config.option.clear()
+            self.config.option.update(saved)
+
+    def __save(self, out: Optional[TextIO]) -> 'Layout':
         if not out:
             out = sys.stdout
+        if self.config.layoutPageDepth > 0 and self.config.outputFormat == "svg":
+            raise ValueError("layoutPageDepth is only supported with outputFormat = dot")
+
+        if not self.templates.is_current(self.config):
+            self.__update_templates()
 
         # Support multiple layouts.
         layout_name = "Layout"
@@ -304,14 +756,122 @@ class Model:
         else:
             layout = Layout(self, out)
 
-        layout.calc()
-        layout.render()
+        if self.config.layoutMaxNodes > 0:
+            layout.fit_budget()
+        # Pages are written to files, those are not cached.
+        if not self.config.outputCacheDir or self.config.layoutPageDepth > 0:
+            layout.calc()
+            layout.render()
+            return cast(Layout, layout)
+
+        cache = OutputCache(self.config)
+        layout.output_key = cache.get_key(layout)
+        content = cache.read(layout.output_key)
+        if content is None:
+            layout.out = io.StringIO()
+            layout.calc()
+            layout.render()
+            content = layout.out.getvalue().encode("utf-8")
+            cache.write(layout.output_key, content)
+            layout.out = out
+        elif self.thumbnail_cache:
+            cache.touch_thumbnails(layout, self.thumbnail_cache)
+        out.write(content.decode("utf-8"))
+        return cast(Layout, layout)
+
+    def __update_templates(self) -> None:
+        """Builds the templates again, the prepared labels are based on the old ones."""
+        self.templates = Templates(self.config)
+        self.labels = {}
+
+    def get_root_families(self) -> List[str]:
+        """Returns the IDs of the families matching rootFamilies, in the order
+        of the input."""
+        self.__load_all()
+        patterns = [i.strip() for i in self.config.rootFamilies.split(",") if i.strip()]
+        return [i.fid for i in self.families if i.fid and any(fnmatch.fnmatchcase(i.fid, j) for j in patterns)]
+
+    def save_with(self, out: TextIO, options: Dict[str, Any]) -> 'Layout':
+        """Same as save(), but with some options overwritten for this save only."""
+        saved = dict(self.config.option)
+        self.config.option.update(options)
+        try:
+            return self.save(out)
+        finally:
+            self.config.option.clear()
+            self.config.option.update(saved)
+
+    def save_families(self, fids: List[str]) -> None:
+        """Saves a chart for each family in fids to outputDir, one file per family."""
+        if self.config.outputFormat == "svg":
+            suffix = ".svg"
+        else:
+            suffix = ".dot"
+        # The charts are written to temporary files first, so pages are named
+        # after the final ones, and don't overwrite the pages of other charts.
+        page_dir, page_name = os.path.split(self.config.pageFormat)
+        page_dir = os.path.join(self.config.outputDir, page_dir)
+        for fid in fids:
+            # Placeholders of the previous chart would change the IDs in this one.
+            self.__drop_placeholders()
+            # Write to a temporary file first, so no partial output is left behind.
+            handle, temp_path = tempfile.mkstemp(dir=self.config.outputDir, suffix=suffix)
+            try:
+                page_format = os.path.join(page_dir, fid.replace("%", "%%") + "-" + page_name)
+                with os.fdopen(handle, "w", encoding=self.config.outputEncoding) as stream:
+                    self.save_with(stream, {"rootFamily": fid, "pageFormat": page_format})
+                os.replace(temp_path, os.path.join(self.config.outputDir, fid + suffix))
+            except (NoSuchFamilyException, NoSuchIndividualException) as exception:
+                sys.stderr.write("Skipping family '%s': %s\n" % (fid, exception))
+            finally:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+
+    def __drop_placeholders(self) -> None:
+        """Forgets the placeholder individuals, they are created again when needed."""
+        if not self.placeholders:
+            return
+        individuals = {i for _family, i in self.placeholders}
+        self.individuals = [i for i in self.individuals if i not in individuals]
+        for family, individual in self.placeholders:
+            if family._husb is individual:
+                family._husb = None
+            if family._wife is individual:
+                family._wife = None
+            if self.individual_index.get(individual.iid) is individual:
+                del self.individual_index[individual.iid]
+        self.placeholders = []
+        self.name_index = None
+
+    def save_batch(self) -> None:
+        """Saves charts for each family matching rootFamilies, using batchJobs
+        processes, parsing the input only once."""
+        fids = self.get_root_families()
+        os.makedirs(self.config.outputDir, exist_ok=True)
+        jobs = min(self.config.batchJobs, len(fids))
+        if jobs <= 1:
+            self.save_families(fids)
+            return
+
+        records = self.get_records()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            # Each worker gets every jobs-th family. Workers resolve pictures
+            # on their own, only the thumbnails on disk are shared.
+            futures = [executor.submit(save_chunk, self.config.config_dict, self.basedir, records, fids[i::jobs]) for i in range(jobs)]
+            for future in futures:
+                future.result()
 
     @staticmethod
     def escape(string: str) -> str:
         return string.replace("-", "_")
 
 
+# Matches a level 0 line, the group is the rest of the line.
+LEVEL0_PATTERN = re.compile(rb"^(?:\xef\xbb\xbf)?0 ([^\r\n]*)", re.MULTILINE)
+# Matches a name line of an individual, the group is the name.
+NAME_PATTERN = re.compile(rb"^1 NAME ([^\r\n]*)", re.MULTILINE)
+
+
 # Layout (view)
 
 class Edge(Renderable):
@@ -319,15 +879,11 @@ class Edge(Renderable):
     def __init__(self, model: Model, from_node: str, to_node: str, invisible: bool = False, comment: Optional[str] = None) -> None:
         self.from_node = from_node
         self.to_node = to_node
-        self.rest = ""
+        self.invisible = invisible
         if invisible:
-            if model.config.edgeInvisibleRed:
-                self.rest += "[ color = red ]"
-            else:
-                self.rest += "[ style = invis ]"
+            self.rest = model.templates.edge_invisible
         else:
-            if not model.config.edgeVisibleDirected:
-                self.rest += "[ arrowhead = none ]"
+            self.rest = model.templates.edge_visible
         if comment:
             self.rest += "// %s" % comment
 
@@ -340,15 +896,19 @@ class Node(Renderable):
     def __init__(self, id_string: str, rest: str = "", point: bool = False, visiblePoint: bool = False, comment: str = "") -> None:
         self.node_id = id_string
         self.rest = rest
+        self.point = point or visiblePoint
+        self.visible_point = visiblePoint
         if point:
             self.rest += "[ shape = point, width = 0 ]"
         elif visiblePoint:
             self.rest += "[ shape = point ]"
-        if comment:
-            self.rest += " // %s" % comment
+        self.comment = comment
 
     def render(self, out: TextIO) -> None:
-        out.write("%s %s\n" % (self.node_id, self.rest))
+        if self.comment:
+            out.write("%s %s // %s\n" % (self.node_id, self.rest, self.comment))
+        else:
+            out.write("%s %s\n" % (self.node_id, self.rest))
 
 
 class Subgraph:
@@ -371,50 +931,148 @@ class Subgraph:
         def render(self, out: TextIO) -> None:
             out.write("}\n")
 
-    def __init__(self, name: str, model: Model) -> None:
+    # Difference of the positions of neighbouring elements after renumbering.
+    spacing = 1 << 32
+
+    def __init__(self, name: str, model: Model, depth: int = 0) -> None:
         self.name = name
         self.model = model
-        self.elements = []  # type: List[Renderable]
+        # The generation this subgraph belongs to.
+        self.depth = depth
+        # Elements form a linked list, so inserting anywhere is cheap: the
+        # first and last element, element ID -> previous / next element and
+        # element ID -> position, see get_position().
+        self.first = None  # type: Optional[Renderable]
+        self.last = None  # type: Optional[Renderable]
+        self.prev_of = {}  # type: Dict[int, Optional[Renderable]]
+        self.next_of = {}  # type: Dict[int, Optional[Renderable]]
+        self.positions = {}  # type: Dict[int, int]
+        # Node ID -> nodes, edge endpoint -> edges. Edges have to be changed
+        # using move_edges_to() / move_edges_from(), so these are kept up to
+        # date.
+        self.nodes = {}  # type: Dict[str, List[Node]]
+        self.edges_to = {}  # type: Dict[str, List[Edge]]
+        self.edges_from = {}  # type: Dict[str, List[Edge]]
         self.start = Subgraph.Start(name)
 
+    @property
+    def elements(self) -> Tuple[Renderable, ...]:
+        """All elements, in order. This is a copy: use prepend(), append()
+        or insert_before() to add elements."""
+        return tuple(self)
+
+    def __iter__(self) -> Iterator[Renderable]:
+        element = self.first
+        while element is not None:
+            yield element
+            element = self.next_of[id(element)]
+
+    def __add_to_index(self, element: Renderable) -> None:
+        if element.__class__ == Node:
+            node = cast(Node, element)
+            self.nodes.setdefault(node.node_id, []).append(node)
+        elif element.__class__ == Edge:
+            edge = cast(Edge, element)
+            self.edges_to.setdefault(edge.to_node, []).append(edge)
+            self.edges_from.setdefault(edge.from_node, []).append(edge)
+
+    def __link(self, element: Renderable, prev: Optional[Renderable], next_element: Optional[Renderable], position: int) -> None:
+        """Adds element between prev and next_element."""
+        key = id(element)
+        assert key not in self.positions
+        self.prev_of[key] = prev
+        self.next_of[key] = next_element
+        self.positions[key] = position
+        if prev is None:
+            self.first = element
+        else:
+            self.next_of[id(prev)] = element
+        if next_element is None:
+            self.last = element
+        else:
+            self.prev_of[id(next_element)] = element
+        self.__add_to_index(element)
+
+    def __renumber(self) -> None:
+        for index, element in enumerate(self):
+            self.positions[id(element)] = index * Subgraph.spacing
+
     def prepend(self, element: Renderable) -> None:
-        self.elements.insert(0, element)
+        position = 0
+        if self.first is not None:
+            position = self.positions[id(self.first)] - Subgraph.spacing
+        self.__link(element, None, self.first, position)
 
     def append(self, element: Renderable) -> None:
-        self.elements.append(element)
+        position = 0
+        if self.last is not None:
+            position = self.positions[id(self.last)] + Subgraph.spacing
+        self.__link(element, self.last, None, position)
+
+    def insert_before(self, existing: Optional[Renderable], element: Renderable) -> None:
+        """Inserts element before existing, or at the start if existing is None."""
+        prev = None
+        if existing is not None:
+            prev = self.prev_of[id(existing)]
+        if existing is None or prev is None:
+            self.prepend(element)
+            return
+        if self.positions[id(existing)] - self.positions[id(prev)] < 2:
+            # No free position between them, which is rare with the spacing.
+            self.__renumber()
+        position = (self.positions[id(prev)] + self.positions[id(existing)]) // 2
+        self.__link(element, prev, existing, position)
+
+    def get_position(self, element: Renderable) -> int:
+        """Returns a number which orders the elements: earlier elements have
+        smaller numbers. It's not the index of the element."""
+        return self.positions[id(element)]
+
+    def move_edges_to(self, old: str, new: str) -> None:
+        """Changes the edges ending in old to end in new."""
+        edges = self.edges_to.pop(old, [])
+        for edge in edges:
+            edge.to_node = new
+        self.edges_to.setdefault(new, []).extend(edges)
+
+    def move_edges_from(self, old: str, new: str) -> None:
+        """Changes the edges starting from old to start from new."""
+        edges = self.edges_from.pop(old, [])
+        for edge in edges:
+            edge.from_node = new
+        self.edges_from.setdefault(new, []).extend(edges)
 
     def end(self) -> None:
         self.append(Subgraph.End())
 
     def render(self, out: TextIO) -> None:
         self.start.render(out)
-        for i in self.elements:
+        for i in self:
             i.render(out)
         out.write("\n")
 
-    def find_family(self, family: Family) -> Tuple[str, int]:
+    def find_family(self, family: Family) -> Tuple[str, Optional[Node]]:
         """Find the wife or husb or a family in this subgraph.
-        If any of them are found, return the individual's ID and pos."""
-        count = 0
-        for element in self.elements:
-            if element.__class__ == Node:
-                node = cast(Node, element)
-                if family.wife and node.node_id == family.wife.iid:
-                    return (family.wife.iid, count)
-                if family.husb and node.node_id == family.husb.iid:
-                    return (family.husb.iid, count)
-            count += 1
-        return ("", 0)
+        If any of them are found, return the individual's ID and node."""
+        candidates = []  # type: List[Node]
+        if family.wife:
+            candidates += self.nodes.get(family.wife.iid, [])
+        if family.husb:
+            candidates += self.nodes.get(family.husb.iid, [])
+        if not candidates:
+            return ("", None)
+        node = min(candidates, key=self.get_position)
+        return (node.node_id, node)
 
     def get_prev_of(self, individual: Individual) -> Optional[Individual]:
         """The passed individual follows the returned ID in this subgraph."""
-        for element in self.elements:
-            if element.__class__ == Edge:
-                edge = cast(Edge, element)
-                if hasattr(individual, 'iid') and edge.to_node == individual.iid:
-                    return self.model.get_individual(edge.from_node)
-
-        return None
+        if not hasattr(individual, 'iid'):
+            return None
+        edges = self.edges_to.get(individual.iid, [])
+        if not edges:
+            return None
+        edge = min(edges, key=self.get_position)
+        return self.model.get_individual(edge.from_node)
 
 
 class Marriage:
@@ -438,42 +1096,251 @@ class Layout:
         self.model = model
         self.out = out
         self.subgraphs = []  # type: List[Subgraph]
-        # List of families, which are directly interesting for us.
-        self.filtered_families = []  # type: List[Family]
+        # Name -> subgraph.
+        self.subgraph_index = {}  # type: Dict[str, Subgraph]
+        # Ordered set of families, which are directly interesting for us.
+        self.filtered_families = collections.OrderedDict()  # type: Dict[Family, None]
+        # Depth -> filtered families, in the order of filtered_families.
+        self.depth_families = {}  # type: Dict[int, List[Family]]
+        # Families read by calc() or estimate(), see get_dependencies().
+        self.read_families = set()  # type: Set[Family]
+        # Key of the output in the output cache, if it's used.
+        self.output_key = None  # type: Optional[str]
+        # The depths used by this layout, if fit_budget() reduced them.
+        self.depths = {}  # type: Dict[str, int]
+        # The sibling families, once get_sibling_families() filtered the families.
+        self.sibling_families = None  # type: Optional[List[Family]]
 
     def append(self, subgraph: Subgraph) -> None:
         self.subgraphs.append(subgraph)
+        self.subgraph_index[subgraph.name] = subgraph
+
+    def add_filtered_family(self, family: Family) -> None:
+        self.filtered_families[family] = None
+
+    def bucket_families(self) -> None:
+        """Groups filtered families by depth, once their depth is final."""
+        self.depth_families = {}
+        for family in self.filtered_families:
+            self.depth_families.setdefault(family.depth, []).append(family)
 
     def render(self) -> None:
-        self.out.write("digraph tree {\n")
-        self.out.write("splines = ortho\n")
-        for i in self.subgraphs:
-            i.render(self.out)
-        self.out.write("}\n")
+        if self.model.config.outputFormat == "svg":
+            SvgWriter(self).write(self.out)
+            return
 
-    def get_subgraph(self, id_string: str) -> Optional[Subgraph]:
+        if self.model.config.layoutPageDepth > 0:
+            pages = self.render_pages()
+            self.out.write(pages[0])
+            for number, page in enumerate(pages[1:], 2):
+                with open(self.get_page_path(number), "w", encoding=self.model.config.outputEncoding) as stream:
+                    stream.write(page)
+            return
+
+        self.out.write(self.render_graph(self.subgraphs, []))
+
+    def get_page_path(self, number: int) -> str:
+        """Path of a page after the first one. A relative pageFormat is
+        relative to the output, in case that's a file."""
+        path = cast(str, self.model.config.pageFormat) % number
+        name = getattr(self.out, "name", None)
+        if isinstance(name, str) and os.path.isfile(name):
+            path = os.path.join(os.path.dirname(name), path)
+        return path
+
+    @staticmethod
+    def render_graph(subgraphs: List[Subgraph], stubs: List[Node]) -> str:
+        # Render to memory first, so the output gets a single large write.
+        out = io.StringIO()
+        out.write("digraph tree {\n")
+        out.write("splines = ortho\n")
+        for i in subgraphs:
+            i.render(out)
+        for stub in stubs:
+            stub.render(out)
+        out.write("}\n")
+        return out.getvalue()
+
+    def get_pages(self) -> List[List[Subgraph]]:
+        """Splits the subgraphs into pages, each page has layoutPageDepth
+        generations. The first page contains the root family, pages without
+        nodes are omitted."""
+        page_depth = self.model.config.layoutPageDepth
+        min_depth = min(i.depth for i in self.subgraphs)
+        pages = {}  # type: Dict[int, List[Subgraph]]
         for subgraph in self.subgraphs:
-            if subgraph.name == id_string:
-                return subgraph
-        return None
+            pages.setdefault((subgraph.depth - min_depth) // page_depth, []).append(subgraph)
+        return [pages[i] for i in sorted(pages) if any(j.nodes for j in pages[i])]
+
+    def render_pages(self) -> List[str]:
+        """Renders each page as a separate graph. Nodes of other pages that
+        are referred by edges are added to the page as stubs, with a label
+        referring to the page number of the node."""
+        pages = self.get_pages()
+        # Node ID -> page number and node.
+        node_pages = {}  # type: Dict[str, Tuple[int, Node]]
+        for number, page in enumerate(pages, 1):
+            for subgraph in page:
+                for node_id, nodes in subgraph.nodes.items():
+                    if nodes and node_id not in node_pages:
+                        node_pages[node_id] = (number, nodes[0])
+
+        ret = []
+        for number, page in enumerate(pages, 1):
+            node_ids = set()  # type: Set[str]
+            endpoints = set()  # type: Set[str]
+            for subgraph in page:
+                node_ids.update(i for i in subgraph.nodes if subgraph.nodes[i])
+                endpoints.update(i for i in subgraph.edges_from if subgraph.edges_from[i])
+                endpoints.update(i for i in subgraph.edges_to if subgraph.edges_to[i])
+            stubs = []
+            for node_id in sorted(endpoints - node_ids):
+                if node_id not in node_pages:
+                    continue
+                node_page, node = node_pages[node_id]
+                stub = Node(node_id, node.rest + ' [ style = dashed, xlabel = "page %s" ]' % node_page, comment=node.comment)
+                stubs.append(stub)
+            ret.append(self.render_graph(page, stubs))
+        return ret
+
+    def get_subgraph(self, id_string: str) -> Optional[Subgraph]:
+        return self.subgraph_index.get(id_string)
+
+    def prepare_labels(self, families: List[Family]) -> None:
+        """Scales the pictures of the individuals in families in parallel,
+        using labelJobs threads, then generates their labels. Building
+        subgraphs then only reads them."""
+        if self.model.config.labelJobs <= 1:
+            return
+
+        individuals = []  # type: List[Individual]
+        for family in families:
+            # Don't use get_husb() / get_wife(), placeholders are created while building subgraphs.
+            for individual in (family.husb, family.wife):
+                if individual:
+                    individuals.append(individual)
+            for chil in family.chil:
+                child = self.model.get_individual(chil)
+                if child:
+                    individuals.append(child)
+        individuals = [i for i in individuals if i not in self.model.labels]
+        if self.model.templates.uses_gw_index and self.model.name_index is None:
+            # Build this before the threads would do so.
+            self.model.build_name_index()
+
+        # Each picture is scaled by a single thread, as individuals may share
+        # one, e.g. placeholders.
+        by_picture = {}  # type: Dict[str, Individual]
+        for individual in individuals:
+            by_picture.setdefault(individual.get_label_picture(), individual)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.model.config.labelJobs) as executor:
+            list(executor.map(Individual.get_shown_picture, by_picture.values()))
+        for individual in individuals:
+            self.model.labels[individual] = individual.get_label()
+
+    def get_dependencies(self) -> Set[str]:
+        """Returns the IDs of the individuals and families the output depends
+        on: the families read by the layout, their members and children."""
+        dependencies = set()  # type: Set[str]
+        for family in self.read_families:
+            if family.fid is not None:
+                dependencies.add(family.fid)
+            dependencies.update(i.iid for i in (family.husb, family.wife) if i)
+            dependencies.update(family.chil)
+        return dependencies
+
+    def is_child_shown(self, family: Family, chil: str) -> bool:
+        individual = self.model.get_individual(chil)
+        return not individual or family.depth <= self.model.config.layoutMaxSiblingDepth or individual.fams in self.filtered_families
+
+    def estimate(self) -> Tuple[int, int]:
+        """Estimates the number of nodes and edges calc() would produce,
+        without generating labels. Returns a (nodes, edges) pair."""
+        sibling_families = self.filter_families()
+        self.read_families.update(self.filtered_families, sibling_families)
+        nodes = 0
+        edges = 0
+        for family in self.filtered_families:
+            # Husb, wife, marriage, the edges between them and to the previous family.
+            nodes += 3
+            edges += 4
+            children = len([i for i in family.chil if self.is_child_shown(family, i)])
+            # The child and its connector node, the edges between them and to the next child.
+            nodes += 2 * children
+            edges += 3 * children
+            if family.chil and len(family.chil) % 2 == 0:
+                # Connector for the marriage.
+                nodes += 1
+                edges += 1
+        for family in sibling_families:
+            nodes += 2
+            edges += 2
+            if family.chil and family.depth <= self.model.config.layoutMaxSiblingFamilyDepth:
+                nodes += 2 * len(family.chil) + 2
+                edges += 3 * len(family.chil) + 2
+        return nodes, edges
+
+    def fit_budget(self) -> None:
+        """Reduces the layout depths till the estimated number of nodes is
+        not more than layoutMaxNodes. The sibling family and sibling spouse
+        depths are reduced first, then layoutMaxDepth. The sibling depth
+        just follows layoutMaxDepth, hiding siblings only in some generations
+        is not something to do implicitly."""
+        option = self.model.config.option
+        nodes, edges = self.estimate()
+        if nodes <= option["layoutMaxNodes"]:
+            return
+
+        sys.stderr.write("The layout would have about %s nodes and %s edges, more than layoutMaxNodes (%s).\n" % (nodes, edges, option["layoutMaxNodes"]))
+        sibling_names = ("layoutMaxSiblingFamilyDepth", "layoutMaxSiblingSpouseDepth")
+        all_names = ("layoutMaxDepth", "layoutMaxSiblingDepth") + sibling_names
+        while nodes > option["layoutMaxNodes"]:
+            for name in all_names[1:]:
+                option[name] = min(option[name], option["layoutMaxDepth"])
+            name = max(sibling_names, key=lambda i: option[i])
+            if option[name] <= 0:
+                name = "layoutMaxDepth"
+                if option[name] <= 0:
+                    break
+            option[name] -= 1
+            nodes, edges = self.estimate()
+        option["layoutMaxSiblingDepth"] = min(option["layoutMaxSiblingDepth"], option["layoutMaxDepth"])
+        self.depths = {i: option[i] for i in all_names}
+        depths = ", ".join("%s = %s" % (i, option[i]) for i in all_names)
+        sys.stderr.write("Reduced the layout to about %s nodes and %s edges: %s.\n" % (nodes, edges, depths))
 
     def make_edge(self, from_id: str, to_id: str, invisible: bool = False, comment: Optional[str] = None) -> Edge:
         return Edge(self.model, from_id, to_id, invisible=invisible, comment=comment)
 
+    def get_sibling_families(self) -> List[Family]:
+        """Same as filter_families(), but filters only on first use, as the
+        key of a cached output needs the families before calc()."""
+        if self.sibling_families is None:
+            self.sibling_families = self.filter_families()
+            self.read_families.update(self.filtered_families, self.sibling_families)
+        return self.sibling_families
+
     def filter_families(self) -> List[Family]:
         """Iterate over all families, find out directly interesting and sibling
-        families. Populates filtered_families, returns sibling ones."""
+        families. Populates filtered_families, returns sibling ones.
+
+        In case of pedigree collapse, a family is only visited once, at the
+        smallest depth it's reached, so shared ancestors are drawn once and
+        the cost is linear in the number of shown families."""
 
         family = self.model.get_family(self.model.config.rootFamily)
         if not family:
             raise NoSuchFamilyException("Can't find family '%s' in the input file." % self.model.config.rootFamily)
-        self.filtered_families = [family]
+        self.filtered_families = collections.OrderedDict()
+        self.add_filtered_family(family)
 
         depth = 0
         pendings = [family]
         # List of families, which are interesting for us, as A is in the
         # family, B is in filtered_families, and A is a sibling of B.
         sibling_families = []
+        # Set of sibling_families.
+        seen_sibling_families = set()  # type: Set[Family]
         while depth < self.model.config.layoutMaxDepth:
             next_pendings = []
             for pending in pendings:
@@ -481,9 +1348,9 @@ class Layout:
                 for indi in ('husb', 'wife'):
                     if getattr(pending, indi):
                         indi_family = getattr(pending, indi).famc
-                        if indi_family:
+                        if indi_family and indi_family not in self.filtered_families:
                             indi_family.depth = depth + 1
-                            self.filtered_families.append(indi_family)
+                            self.add_filtered_family(indi_family)
                             next_pendings.append(indi_family)
                             children += indi_family.chil
 
@@ -495,13 +1362,15 @@ class Layout:
                         if not individual:
                             raise NoSuchIndividualException("Can't find individual '%s' in the input file." % chil)
                         chil_family = individual.fams
-                        if not chil_family or self.model.get_family(chil_family.fid, self.filtered_families):
+                        if not chil_family or chil_family in self.filtered_families or chil_family in seen_sibling_families:
                             continue
                         chil_family.depth = depth
                         sibling_families.append(chil_family)
+                        seen_sibling_families.add(chil_family)
             pendings = next_pendings
             depth += 1
 
+        self.bucket_families()
         for i in self.filtered_families:
             i.sort_children(self.filtered_families)
 
@@ -515,7 +1384,7 @@ class Layout:
         2) Pending children from the previous generation.
 
         Returns pending children for the next subgraph."""
-        subgraph = Subgraph(self.model.escape("Depth%s" % depth), self.model)
+        subgraph = Subgraph(self.model.escape("Depth%s" % depth), self.model, depth)
         for child in pending_child_nodes:
             subgraph.append(child)
         pending_child_nodes = []
@@ -523,7 +1392,7 @@ class Layout:
         pending_children_deps = []
         prev_wife = None
         prev_chil = None
-        for family in [f for f in self.filtered_families if f.depth == depth]:
+        for family in self.depth_families.get(depth, []):
             husb = family.get_husb()
             subgraph.append(husb.get_node())
             if prev_wife:
@@ -564,10 +1433,10 @@ class Layout:
 
     def build_connector_subgraph(self, depth: int) -> None:
         """Does the same as build_subgraph(), but deals with connector nodes."""
-        subgraph = Subgraph(self.model.escape("Depth%sConnects" % depth), self.model)
+        subgraph = Subgraph(self.model.escape("Depth%sConnects" % depth), self.model, depth)
         pending_deps = []
         prev_child = None
-        for family in [f for f in self.filtered_families if f.depth == depth]:
+        for family in self.depth_families.get(depth, []):
             marriage = Marriage(family)
             children = family.chil[:]
             if not (len(children) % 2 == 1 or not children):
@@ -619,7 +1488,7 @@ class Layout:
         depth = family.depth
         subgraph = self.get_subgraph(self.model.escape("Depth%s" % depth))
         assert subgraph
-        existing_indi, existing_pos = subgraph.find_family(family)
+        existing_indi, existing_node = subgraph.find_family(family)
         new_indi = None
         if family.wife and existing_indi == family.wife.iid:
             new_indi = family.husb
@@ -628,18 +1497,16 @@ class Layout:
         if not new_indi:
             # No spouse, probably has children. Ignore for now.
             return
-        found = False
-        for element in subgraph.elements:
-            if existing_indi == family.wife.iid and element.__class__ == Edge and cast(Edge, element).to_node == existing_indi:
-                cast(Edge, element).to_node = new_indi.iid
-            elif existing_indi == family.husb.iid and element.__class__ == Edge and cast(Edge, element).from_node == existing_indi:
-                cast(Edge, element).from_node = new_indi.iid
-            found = True
-        assert found
-        subgraph.elements.insert(existing_pos, new_indi.get_node())
+        assert subgraph.first
+        if existing_indi == family.wife.iid:
+            subgraph.move_edges_to(existing_indi, new_indi.iid)
+        elif existing_indi == family.husb.iid:
+            subgraph.move_edges_from(existing_indi, new_indi.iid)
+        new_node = new_indi.get_node()
+        subgraph.insert_before(existing_node, new_node)
 
         marriage = Marriage(family)
-        subgraph.elements.insert(existing_pos, marriage.get_node())
+        subgraph.insert_before(new_node, marriage.get_node())
 
         subgraph.append(self.make_edge(family.husb.iid, marriage.get_name(), comment=family.husb.get_full_name()))
         subgraph.append(self.make_edge(marriage.get_name(), family.wife.iid, comment=family.wife.get_full_name()))
@@ -706,7 +1573,8 @@ class Layout:
         defined, the exact positions and sizes are still determined by
         graphviz."""
 
-        sibling_families = self.filter_families()
+        sibling_families = self.get_sibling_families()
+        self.prepare_labels(list(self.filtered_families) + sibling_families)
 
         # Children from generation N are nodes in the N+1th generation.
         pending_child_nodes = []  # type: List[Renderable]
@@ -728,9 +1596,12 @@ class Layout:
 class DescendantsLayout(Layout):
     """A layout that shows all descendants of a root family."""
     def filter_families(self) -> List[Family]:
+        """Populates filtered_families with the descendant families, each of
+        them is only visited once."""
         family = self.model.get_family(self.model.config.rootFamily)
         assert family
-        self.filtered_families = [family]
+        self.filtered_families = collections.OrderedDict()
+        self.add_filtered_family(family)
 
         depth = 0
         pendings = [family]
@@ -741,17 +1612,19 @@ class DescendantsLayout(Layout):
                     individual = self.model.get_individual(indi)
                     assert individual
                     indi_family = individual.fams
-                    if indi_family:
+                    if indi_family and indi_family not in self.filtered_families:
                         indi_family.depth = depth + 1
-                        self.filtered_families.append(indi_family)
+                        self.add_filtered_family(indi_family)
                         next_pendings.append(indi_family)
             pendings = next_pendings
             depth += 1
 
+        self.bucket_families()
         return []
 
     def calc(self) -> None:
-        self.filter_families()
+        self.get_sibling_families()
+        self.prepare_labels(list(self.filtered_families))
 
         pending_child_nodes = []  # type: List[Renderable]
         for depth in range(self.model.config.layoutMaxDepth + 1):
@@ -759,98 +1632,738 @@ class DescendantsLayout(Layout):
             self.build_connector_subgraph(depth)
 
 
+class SvgWriter:
+    """Positions the nodes of a calculated layout and writes them as SVG,
+    without graphviz. Each non-empty subgraph is a row. The order inside a
+    row follows the edges inside the row, then the order of the nodes. The
+    x positions are averaged from the connected nodes of the neighbouring
+    rows, a few times top-down and bottom-up."""
+    font_size = 14
+    char_width = 7
+    line_height = 17
+    padding = 8
+    node_gap = 20
+    row_gap = 30
+    margin = 10
+    iterations = 4
+
+    # Content and size of a node, its position is in x and y.
+    Box = NamedTuple("Box", [("node", Node), ("lines", List[str]), ("picture", Optional[str]), ("color", str), ("width", float), ("height", float)])
+
+    def __init__(self, layout: Layout) -> None:
+        self.model = layout.model
+        self.rows = []  # type: List[List[str]]
+        self.boxes = {}  # type: Dict[str, SvgWriter.Box]
+        # Position of the boxes, x is the center, y is the top.
+        self.x = {}  # type: Dict[str, float]
+        self.y = {}  # type: Dict[str, float]
+        self.edges = []  # type: List[Edge]
+        for subgraph in layout.subgraphs:
+            row = []  # type: List[str]
+            for element in subgraph.elements:
+                if element.__class__ == Node:
+                    node = cast(Node, element)
+                    if node.node_id not in self.boxes:
+                        self.boxes[node.node_id] = self.__get_box(node)
+                        row.append(node.node_id)
+                elif element.__class__ == Edge:
+                    self.edges.append(cast(Edge, element))
+            if row:
+                self.rows.append(row)
+
+    @staticmethod
+    def parse_label(label: str) -> Tuple[List[str], Optional[str]]:
+        """Extracts the text lines and the picture from a graphviz label."""
+        picture = None
+        if label.startswith("<") and label.endswith(">"):
+            match = re.search(r'<img src="([^"]*)"', label)
+            if match:
+                picture = html.unescape(match.group(1))
+            text = re.sub(r"<br\s*/?>|</tr>", "\n", label[1:-1])
+            lines = [html.unescape(i) for i in re.sub(r"<[^>]*>", "", text).split("\n")]
+        else:
+            lines = label.strip('"').split("\\n")
+        return [i.strip() for i in lines if i.strip()], picture
+
+    def __get_box(self, node: Node) -> 'SvgWriter.Box':
+        if node.point:
+            return SvgWriter.Box(node, [], None, "black", 0.0, 0.0)
+        picture = None  # type: Optional[str]
+        color = "black"
+        individual = self.model.get_individual(node.node_id)
+        if individual:
+            label = self.model.labels.get(individual)
+            if label is None:
+                label = individual.get_label()
+            lines, picture = self.parse_label(label)
+            color = individual.get_color()
+        else:
+            lines = [node.node_id]
+        text_width = max([len(i) for i in lines] + [0]) * self.char_width
+        height = len(lines) * self.line_height + 2 * self.padding
+        if picture:
+            text_width = max(text_width, THUMBNAIL_SIZE[0])
+            height += THUMBNAIL_SIZE[1] + self.padding
+        return SvgWriter.Box(node, lines, picture, color, float(text_width + 2 * self.padding), float(height))
+
+    def __sort_row(self, row: List[str]) -> List[str]:
+        """Orders a row, so the edges inside the row go left to right."""
+        position = {node_id: i for i, node_id in enumerate(row)}
+        after = {node_id: [] for node_id in row}  # type: Dict[str, List[str]]
+        before_count = {node_id: 0 for node_id in row}
+        for edge in self.edges:
+            if edge.from_node in position and edge.to_node in position and edge.from_node != edge.to_node:
+                after[edge.from_node].append(edge.to_node)
+                before_count[edge.to_node] += 1
+        heap = [(position[i], i) for i in row if not before_count[i]]
+        heapq.heapify(heap)
+        ret = []  # type: List[str]
+        while heap:
+            _, node_id = heapq.heappop(heap)
+            ret.append(node_id)
+            for i in after[node_id]:
+                before_count[i] -= 1
+                if not before_count[i]:
+                    heapq.heappush(heap, (position[i], i))
+        if len(ret) < len(row):
+            # Cycle, keep the rest in order.
+            seen = set(ret)
+            ret += [i for i in row if i not in seen]
+        return ret
+
+    def __align(self, row: List[str], neighbours: Dict[str, List[str]], beside: Dict[str, List[str]]) -> None:
+        """Moves the nodes of a row towards their neighbours, keeping the
+        order. Nodes without neighbours move towards the ones beside them."""
+        desired = []
+        for node_id in row:
+            positions = [self.x[i] for i in neighbours[node_id]]
+            if not positions:
+                positions = [self.x[i] for i in beside[node_id]]
+            if positions:
+                desired.append(sum(positions) / len(positions))
+            else:
+                desired.append(self.x[node_id])
+        distances = [self.boxes[row[i]].width / 2 + self.boxes[row[i + 1]].width / 2 + self.node_gap for i in range(len(row) - 1)]
+        # Pushing the nodes to the right and to the left both keeps the
+        # distances, and so does their average.
+        left = desired[:]
+        for i in range(1, len(row)):
+            left[i] = max(left[i], left[i - 1] + distances[i - 1])
+        right = desired[:]
+        for i in reversed(range(len(row) - 1)):
+            right[i] = min(right[i], right[i + 1] - distances[i])
+        for i, node_id in enumerate(row):
+            self.x[node_id] = (left[i] + right[i]) / 2
+
+    def place(self) -> None:
+        """Sets the position of all boxes."""
+        self.rows = [self.__sort_row(row) for row in self.rows]
+        row_of = {node_id: number for number, row in enumerate(self.rows) for node_id in row}
+
+        above = {node_id: [] for node_id in self.boxes}  # type: Dict[str, List[str]]
+        below = {node_id: [] for node_id in self.boxes}  # type: Dict[str, List[str]]
+        beside = {node_id: [] for node_id in self.boxes}  # type: Dict[str, List[str]]
+        for edge in self.edges:
+            if edge.invisible or edge.from_node not in row_of or edge.to_node not in row_of:
+                continue
+            if row_of[edge.from_node] < row_of[edge.to_node]:
+                below[edge.from_node].append(edge.to_node)
+                above[edge.to_node].append(edge.from_node)
+            elif row_of[edge.from_node] > row_of[edge.to_node]:
+                above[edge.from_node].append(edge.to_node)
+                below[edge.to_node].append(edge.from_node)
+            elif edge.from_node != edge.to_node:
+                beside[edge.from_node].append(edge.to_node)
+                beside[edge.to_node].append(edge.from_node)
+
+        for row in self.rows:
+            x = 0.0
+            for node_id in row:
+                width = self.boxes[node_id].width
+                self.x[node_id] = x + width / 2
+                x += width + self.node_gap
+        for _ in range(self.iterations):
+            for row in self.rows[1:]:
+                self.__align(row, above, beside)
+            for row in reversed(self.rows[:-1]):
+                self.__align(row, below, beside)
+
+        left = min([self.x[i] - box.width / 2 for i, box in self.boxes.items()] + [0])
+        y = float(self.margin)
+        for row in self.rows:
+            height = max(self.boxes[i].height for i in row)
+            for node_id in row:
+                self.x[node_id] += self.margin - left
+                self.y[node_id] = y + (height - self.boxes[node_id].height) / 2
+            y += height + self.row_gap
+
+    def __write_edge(self, out: TextIO, edge: Edge) -> None:
+        if edge.from_node not in self.boxes or edge.to_node not in self.boxes:
+            return
+        if edge.invisible:
+            if not self.model.config.edgeInvisibleRed:
+                return
+            color = "red"
+        else:
+            color = "black"
+        upper = edge.from_node
+        lower = edge.to_node
+        if self.y[upper] + self.boxes[upper].height / 2 > self.y[lower] + self.boxes[lower].height / 2:
+            upper, lower = lower, upper
+        if self.y[upper] + self.boxes[upper].height <= self.y[lower]:
+            middle = (self.y[upper] + self.boxes[upper].height + self.y[lower]) / 2
+            points = [(self.x[upper], self.y[upper] + self.boxes[upper].height), (self.x[upper], middle), (self.x[lower], middle), (self.x[lower], self.y[lower])]
+        else:
+            # Same row.
+            if self.x[upper] > self.x[lower]:
+                upper, lower = lower, upper
+            middle = self.y[upper] + self.boxes[upper].height / 2
+            points = [(self.x[upper] + self.boxes[upper].width / 2, middle), (self.x[lower] - self.boxes[lower].width / 2, middle)]
+        out.write('<polyline fill="none" stroke="%s" points="%s"/>\n' % (color, " ".join("%.1f,%.1f" % i for i in points)))
+
+    def __write_box(self, out: TextIO, node_id: str, box: 'SvgWriter.Box') -> None:
+        x = self.x[node_id]
+        if box.node.point:
+            if box.node.visible_point:
+                out.write('<circle cx="%.1f" cy="%.1f" r="3" fill="black" stroke="black"/>\n' % (x, self.y[node_id]))
+            return
+        left = x - box.width / 2
+        out.write('<g id=%s class="node">\n' % xml.sax.saxutils.quoteattr(node_id))
+        out.write('<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f" fill="none" stroke="%s" stroke-width=%s/>\n'
+                  % (left, self.y[node_id], box.width, box.height, box.color, xml.sax.saxutils.quoteattr(self.model.config.nodeBorderWidth)))
+        y = self.y[node_id] + self.padding
+        if box.picture:
+            out.write('<image xlink:href=%s x="%.1f" y="%.1f" width="%s" height="%s" preserveAspectRatio="xMidYMid meet"/>\n'
+                      % (xml.sax.saxutils.quoteattr(box.picture), x - THUMBNAIL_SIZE[0] / 2, y, THUMBNAIL_SIZE[0], THUMBNAIL_SIZE[1]))
+            y += THUMBNAIL_SIZE[1] + self.padding
+        for line in box.lines:
+            y += self.line_height
+            out.write('<text text-anchor="middle" x="%.1f" y="%.1f" font-family="Times,serif" font-size="%s">%s</text>\n'
+                      % (x, y - 4, self.font_size, xml.sax.saxutils.escape(line)))
+        out.write('</g>\n')
+
+    def write(self, out: TextIO) -> None:
+        self.place()
+        width = max([self.x[i] + box.width / 2 for i, box in self.boxes.items()] + [0]) + self.margin
+        height = max([self.y[i] + box.height for i, box in self.boxes.items()] + [0]) + self.margin
+        buf = io.StringIO()
+        buf.write('<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n')
+        buf.write('<svg width="%.0fpt" height="%.0fpt" viewBox="0 0 %.1f %.1f" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">\n'
+                  % (width, height, width, height))
+        buf.write('<g id="graph0" class="graph">\n')
+        for edge in self.edges:
+            self.__write_edge(buf, edge)
+        for row in self.rows:
+            for node_id in row:
+                self.__write_box(buf, node_id, self.boxes[node_id])
+        buf.write('</g>\n')
+        buf.write('</svg>\n')
+        out.write(buf.getvalue())
+
+
 # Import filter
 
 class GedcomImport:
     """Builds the model from GEDCOM."""
-    def __init__(self, inf: BinaryIO, model: Model) -> None:
+    # Level 1 tags which affect the model.
+    level1Tags = (b"SEX", b"NAME", b"FAMC", b"FAMS", b"BIRT", b"DEAT", b"HUSB", b"WIFE", b"CHIL")
+
+    def __init__(self, inf: BinaryIO, model: Model, first_line: int = 1) -> None:
         self.inf = inf
         self.model = model
+        # Line number of the first line of inf in the input file.
+        self.first_line = first_line
         self.indi = None  # type: Optional[Individual]
         self.family = None  # type: Optional[Family]
         self.in_birt = False
         self.in_deat = False
+        # Records completed by the last line, not yet yielded.
+        self.completed = []  # type: List[Union[Individual, Family]]
 
     def load(self) -> None:
-        linecount = 0
-
-        for i in self.inf.readlines():
-            line = i.strip().decode(self.model.config.inputEncoding)
+        for record in self.parse():
+            if isinstance(record, Individual):
+                self.model.add_individual(record)
+            else:
+                self.model.add_family(record)
+
+    def parse(self) -> Iterator[Union[Individual, Family]]:
+        """Reads the input line by line and yields individuals and families
+        as soon as they are complete, i.e. at the next level 0 line. The input
+        is not read into memory at once. Raises GedcomParseError for lines
+        which can't be parsed."""
+        encoding = self.model.config.inputEncoding
+        # In case of UTF-8, work on bytes and only decode payloads we actually use.
+        fast_path = codecs.lookup(encoding).name == "utf-8"
+        linecount = self.first_line - 1
+
+        for i in self.__readlines():
             linecount += 1
-            tokens = line.split(' ')
-
-            first_token = tokens[0]
-            # Ignore UTF-8 BOM, if there is one at the begining of the line.
-            if first_token.startswith("\ufeff"):
-                first_token = first_token[1:]
-
-            level = int(first_token)
-            rest = " ".join(tokens[1:])
             # try to identify lines with errors
             try:
-                if level == 0:
-                    if self.indi:
-                        self.model.individuals.append(self.indi)
-                        self.indi = None
-                    if self.family:
-                        self.model.families.append(self.family)
-                        self.family = None
-
-                    if rest.startswith("@") and rest.endswith("INDI"):
-                        id_string = rest[1:-6]
-                        if id_string not in self.model.config.indiBlacklist:
-                            self.indi = Individual(self.model)
-                            self.indi.iid = rest[1:-6]
-                    elif rest.startswith("@") and rest.endswith("FAM"):
-                        self.family = Family(self.model)
-                        self.family.fid = rest[1:-5]
-
-                elif level == 1:
-                    if self.in_birt:
-                        self.in_birt = False
-                    elif self.in_deat:
-                        self.in_deat = False
-
-                    if rest.startswith("SEX") and self.indi:
-                        self.indi.sex = rest.split(' ')[1]
-                    elif rest.startswith("NAME") and self.indi:
-                        rest = rest[5:]
-                        tokens = rest.split('/')
-                        self.indi.forename = tokens[0].strip()
-                        if len(tokens) > 1:
-                            self.indi.surname = tokens[1].strip()
-                    elif rest.startswith("FAMC") and self.indi:
-                        # Child in multiple families? That's crazy...
-                        if not self.indi.famc:
-                            self.indi.famc = rest[6:-1]
-                    elif rest.startswith("FAMS") and self.indi:
-                        self.indi.fams = rest[6:-1]
-                    elif rest.startswith("BIRT"):
-                        self.in_birt = True
-                    elif rest.startswith("DEAT"):
-                        self.in_deat = True
-                    elif rest.startswith("HUSB") and self.family:
-                        self.family.husb = rest[6:-1]
-                    elif rest.startswith("WIFE") and self.family:
-                        self.family.wife = rest[6:-1]
-                    elif rest.startswith("CHIL") and self.family:
-                        id_string = rest[6:-1]
-                        if id_string not in self.model.config.indiBlacklist:
-                            self.family.chil.append(rest[6:-1])
-
-                elif level == 2:
-                    if rest.startswith("DATE") and self.indi:
-                        year = rest.split(' ')[-1]
-                        if self.in_birt:
-                            self.indi.set_birt(year)
-                        elif self.in_deat:
-                            self.indi.deat = year
+                if fast_path:
+                    first_token, _, raw_rest = i.strip().partition(b" ")
+                    if first_token.startswith(codecs.BOM_UTF8):
+                        first_token = first_token[len(codecs.BOM_UTF8):]
+                    level = int(first_token)
+                    if not self.__is_interesting(level, raw_rest):
+                        continue
+                    rest = raw_rest.decode(encoding).rstrip()
+                else:
+                    line = i.strip().decode(encoding)
+                    tokens = line.split(' ')
 
+                    first_token_str = tokens[0]
+                    # Ignore UTF-8 BOM, if there is one at the begining of the line.
+                    if first_token_str.startswith("\ufeff"):
+                        first_token_str = first_token_str[1:]
+
+                    level = int(first_token_str)
+                    rest = " ".join(tokens[1:])
+
+                self.__handle_line(level, rest)
             # pylint: disable=broad-except
             except Exception as exc:
-                sys.stderr.write("Encountered parsing error in .ged: " + str(exc) + "\n")
-                sys.stderr.write("line (%d): %s\n" % (linecount, line))
-                sys.exit(1)
+                line_string = i.strip().decode(encoding, errors="replace")
+                raise GedcomParseError("Encountered parsing error in .ged: %s\nline (%d): %s" % (exc, linecount, line_string)) from exc
+
+            if self.completed:
+                yield from self.completed
+                self.completed = []
+
+        # The last record is not followed by a level 0 line in case of lazy loading.
+        if self.indi:
+            yield self.indi
+            self.indi = None
+        if self.family:
+            yield self.family
+            self.family = None
+
+    def __readlines(self) -> Iterator[bytes]:
+        """Reads the input via a memory map if possible, falls back to buffered
+        reading for non-files (e.g. BytesIO) and empty files."""
+        try:
+            mapped = mmap.mmap(self.inf.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            yield from self.inf
+            return
+        try:
+            mapped.seek(self.inf.tell())
+            yield from iter(mapped.readline, b"")
+        finally:
+            mapped.close()
+
+    def __is_interesting(self, level: int, rest: bytes) -> bool:
+        """Decides if a not yet decoded line has to be handled by
+        __handle_line(). Level 1 lines with other tags only end a BIRT or DEAT
+        block, so that is handled here."""
+        if level == 0:
+            return True
+        if level == 1:
+            if rest.startswith(GedcomImport.level1Tags):
+                return True
+            if self.in_birt:
+                self.in_birt = False
+            elif self.in_deat:
+                self.in_deat = False
+            return False
+        if level == 2:
+            return bool(self.indi) and (self.in_birt or self.in_deat) and rest.startswith(b"DATE")
+        return False
+
+    def __handle_line(self, level: int, rest: str) -> None:
+        """Updates the parser state based on a single line."""
+        if level == 0:
+            if self.indi:
+                self.completed.append(self.indi)
+                self.indi = None
+            if self.family:
+                self.completed.append(self.family)
+                self.family = None
+
+            if rest.startswith("@") and rest.endswith("INDI"):
+                id_string = rest[1:-6]
+                if id_string not in self.model.config.indiBlacklist:
+                    self.indi = Individual(self.model)
+                    self.indi.iid = sys.intern(rest[1:-6])
+            elif rest.startswith("@") and rest.endswith("FAM"):
+                self.family = Family(self.model)
+                self.family.fid = sys.intern(rest[1:-5])
+
+        elif level == 1:
+            if self.in_birt:
+                self.in_birt = False
+            elif self.in_deat:
+                self.in_deat = False
+
+            if rest.startswith("SEX") and self.indi:
+                self.indi.sex = sys.intern(rest.split(' ')[1])
+            elif rest.startswith("NAME") and self.indi:
+                rest = rest[5:]
+                tokens = rest.split('/')
+                # Names and years repeat a lot, share the string objects.
+                self.indi.forename = sys.intern(tokens[0].strip())
+                if len(tokens) > 1:
+                    self.indi.surname = sys.intern(tokens[1].strip())
+            elif rest.startswith("FAMC") and self.indi:
+                # Child in multiple families? That's crazy...
+                if not self.indi._famc:
+                    self.indi.famc = rest[6:-1]
+            elif rest.startswith("FAMS") and self.indi:
+                self.indi.fams = rest[6:-1]
+            elif rest.startswith("BIRT"):
+                self.in_birt = True
+            elif rest.startswith("DEAT"):
+                self.in_deat = True
+            elif rest.startswith("HUSB") and self.family:
+                self.family.husb = rest[6:-1]
+            elif rest.startswith("WIFE") and self.family:
+                self.family.wife = rest[6:-1]
+            elif rest.startswith("CHIL") and self.family:
+                id_string = rest[6:-1]
+                if id_string not in self.model.config.indiBlacklist:
+                    self.family.chil.append(sys.intern(id_string))
+
+        elif level == 2:
+            if rest.startswith("DATE") and self.indi:
+                year = sys.intern(rest.split(' ')[-1])
+                if self.in_birt:
+                    self.indi.set_birt(year)
+                elif self.in_deat:
+                    self.indi.deat = year
+
+
+def parse_chunk(config_dict: Any, name: str, start: int, end: int, first_line: int) -> Records:
+    """Parses a part of the input, in a worker process of Model.load()."""
+    model = Model(Config(config_dict))
+    with open(name, "rb") as inf:
+        inf.seek(start)
+        chunk = io.BytesIO(inf.read(end - start))
+    GedcomImport(chunk, model, first_line).load()
+    return model.get_records()
+
+
+def save_chunk(config_dict: Any, basedir: str, records: Records, fids: List[str]) -> None:
+    """Saves charts of a part of the families, in a worker process of Model.save_batch()."""
+    model = Model(Config(config_dict))
+    model.basedir = basedir
+    model.add_records(records)
+    model.resolve()
+    model.save_families(fids)
+
+
+class GedcomIndex:
+    """Index of the records in a GEDCOM file, to allow random access. Can be
+    stored in a <input>.idx file next to the input, which is only re-created
+    when the input changes."""
+    version = 2
+
+    def __init__(self, name: str, encoding: str) -> None:
+        self.name = name
+        self.encoding = encoding
+        # ID -> (start offset, end offset, line number)
+        self.records = {}  # type: Dict[str, Tuple[int, int, int]]
+        # Surname -> list of individual IDs
+        self.surnames = {}  # type: Dict[str, List[str]]
+
+    def get_path(self) -> str:
+        return self.name + ".idx"
+
+    def get_key(self) -> Tuple[int, int, int, str]:
+        stat = os.stat(self.name)
+        return (GedcomIndex.version, stat.st_size, stat.st_mtime_ns, self.encoding)
+
+    def build(self, mapped: Union[bytes, mmap.mmap], with_surnames: bool = True) -> None:
+        """Indexes the content of the input, without parsing the records."""
+        # Level 0 lines start and end records.
+        starts = []  # type: List[Tuple[int, int, str, bool]]
+        linecount = 1
+        prev_start = 0
+        for match in LEVEL0_PATTERN.finditer(mapped):
+            start = match.start()
+            linecount += mapped[prev_start:start].count(b"\n")
+            prev_start = start
+            rest = match.group(1).decode(self.encoding).strip()
+            id_string = ""
+            is_indi = False
+            if rest.startswith("@") and rest.endswith("INDI"):
+                id_string = rest[1:-6]
+                is_indi = True
+            elif rest.startswith("@") and rest.endswith("FAM"):
+                id_string = rest[1:-5]
+            starts.append((start, linecount, id_string, is_indi))
+        ends = [i[0] for i in starts[1:]] + [len(mapped)]
+        self.records = {}
+        self.surnames = {}
+        for (start, linecount, id_string, is_indi), end in zip(starts, ends):
+            if not id_string or id_string in self.records:
+                continue
+            self.records[id_string] = (start, end, linecount)
+            if is_indi and with_surnames:
+                # Same as GedcomImport: the last name wins.
+                surname = ""
+                for match in NAME_PATTERN.finditer(mapped, start, end):
+                    tokens = match.group(1).decode(self.encoding).split('/')
+                    surname = ""
+                    if len(tokens) > 1:
+                        surname = tokens[1].strip()
+                self.surnames.setdefault(surname, []).append(id_string)
+
+    def read(self) -> bool:
+        """Reads the index file, returns if it's still valid for the input.
+        The file may come from anywhere, along with the input, so it's not
+        pickled: a JSON header line with the key, a JSON line with the IDs and
+        surnames, then the offsets as little-endian 64-bit integers. The rest
+        is only read when the key matches."""
+        try:
+            with open(self.get_path(), "rb") as stream:
+                if json.loads(stream.readline().decode("utf-8")) != list(self.get_key()):
+                    return False
+                body = json.loads(stream.readline().decode("utf-8"))
+                offsets = array.array("q")
+                offsets.frombytes(stream.read())
+        except (OSError, ValueError):
+            return False
+        if sys.byteorder == "big":
+            offsets.byteswap()
+        try:
+            ids = body["ids"]
+            if len(offsets) != 3 * len(ids) or not all(isinstance(i, str) for i in ids):
+                return False
+            surnames = {str(key): [str(i) for i in value] for key, value in body["surnames"].items()}
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return False
+        self.records = dict(zip(ids, zip(offsets[0::3], offsets[1::3], offsets[2::3])))
+        self.surnames = surnames
+        return True
+
+    def write(self) -> None:
+        offsets = array.array("q", (i for entry in self.records.values() for i in entry))
+        if sys.byteorder == "big":
+            offsets.byteswap()
+        try:
+            with open(self.get_path(), "wb") as stream:
+                stream.write(json.dumps(list(self.get_key())).encode("utf-8") + b"\n")
+                stream.write(json.dumps({"ids": list(self.records), "surnames": self.surnames}).encode("utf-8") + b"\n")
+                stream.write(offsets.tobytes())
+        except OSError as os_error:
+            sys.stderr.write("// Failed to write index '%s': %s\n" % (self.get_path(), os_error))
+
+
+# Caching
+
+class DiskCache:
+    """A directory of cache entries with a size limit. Least recently used
+    entries are removed first, the modification time of an entry is its last
+    use."""
+    def __init__(self, directory: str, max_size: int, suffix: str) -> None:
+        self.directory = directory
+        # In bytes.
+        self.max_size = max_size
+        self.suffix = suffix
+
+    def get_path(self, key: str) -> str:
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + self.suffix)
+
+    def read(self, key: str) -> Optional[bytes]:
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as stream:
+                content = stream.read()
+        except OSError:
+            return None
+        try:
+            # Mark as recently used.
+            os.utime(path)
+        except OSError:
+            pass
+        return content
+
+    def touch(self, key: str) -> bool:
+        """Marks an entry as recently used, returns if it exists."""
+        try:
+            os.utime(self.get_path(key))
+        except OSError:
+            return False
+        return True
+
+    def write(self, key: str, content: bytes) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write to a temporary file first, so readers never see a partial entry.
+            handle, temp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(handle, "wb") as stream:
+                stream.write(content)
+            os.replace(temp_path, self.get_path(key))
+            self.evict()
+        except OSError as os_error:
+            sys.stderr.write("// Failed to write cache entry in '%s': %s\n" % (self.directory, os_error))
+
+    def evict(self) -> None:
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(self.suffix):
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        entries.sort()
+        for _mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+
+
+class ModelCache(DiskCache):
+    """Caches the parsed records of input files, so unchanged files don't
+    have to be parsed again."""
+    version = 1
+
+    def __init__(self, config: 'Config') -> None:
+        DiskCache.__init__(self, config.modelCacheDir, config.modelCacheSize * 1024 * 1024, ".model")
+        self.config = config
+
+    def get_key(self, name: str) -> str:
+        stat = os.stat(name)
+        # The current year is part of the key, as set_birt() depends on it.
+        return repr((ModelCache.version, os.path.abspath(name), stat.st_size, stat.st_mtime_ns,
+                     self.config.inputEncoding, self.config.indiBlacklist, self.config.considerAgeDead,
+                     time.localtime().tm_year))
+
+    def load(self, name: str, model: Model) -> bool:
+        """Adds the unresolved records of name to model, returns if it was
+        possible to do so from the cache."""
+        content = self.read(self.get_key(name))
+        if content is None:
+            return False
+        try:
+            records = pickle.loads(content)
+        # pylint: disable=broad-except
+        except Exception:
+            return False
+        model.add_records(records)
+        return True
+
+    def save(self, name: str, model: Model) -> None:
+        """Stores the not yet resolved records of model."""
+        self.write(self.get_key(name), pickle.dumps(model.get_records(), pickle.HIGHEST_PROTOCOL))
+
+
+class ThumbnailCache(DiskCache):
+    """Caches pictures scaled to THUMBNAIL_SIZE, so the original pictures are
+    only opened again when they change. An empty entry means that the
+    original picture already has the right size."""
+    version = 1
+
+    def __init__(self, config: 'Config') -> None:
+        DiskCache.__init__(self, config.thumbnailCacheDir, config.thumbnailCacheSize * 1024 * 1024, ".png")
+
+    def get_picture(self, picture: str, full_name: str) -> str:
+        """Returns the path of the picture to show instead of picture."""
+        shown = picture
+        try:
+            stat_result = os.stat(picture)  # type: Optional[os.stat_result]
+        except OSError:
+            stat_result = None
+        if stat_result:
+            key = repr((ThumbnailCache.version, os.path.abspath(picture), stat_result.st_size, stat_result.st_mtime_ns, THUMBNAIL_SIZE))
+            if not self.touch(key):
+                self.__scale(picture, key, full_name)
+            path = self.get_path(key)
+            # No entry (failed to write it) or an empty one: show the original.
+            if os.path.exists(path) and os.path.getsize(path):
+                shown = path
+        return shown
+
+    def __scale(self, picture: str, key: str, full_name: str) -> None:
+        """Creates the entry of picture."""
+        try:
+            from PIL import Image  # type: ignore  # No library stub file for module
+        except ImportError:
+            return
+        with Image.open(picture) as image:
+            if image.size == THUMBNAIL_SIZE:
+                self.write(key, b"")
+                return
+            sys.stderr.write("// Scaling picture of %s as it didn't have 100x100 px\n" % full_name)
+            image.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+            content = io.BytesIO()
+            image.save(content, "PNG")
+        self.write(key, content.getvalue())
+
+
+class OutputCache(DiskCache):
+    """Caches the outputs of Model.save(). The key is made of the options
+    affecting the output and the records of the families read by the layout,
+    so a change elsewhere in the input still gives a hit. Outputs converted
+    from these, e.g. SVG from graphviz, can be stored next to them."""
+    version = 2
+
+    # Options which don't affect the output of a single save.
+    ignored_options = ("input", "rootFamilies", "outputDir", "batchJobs", "labelJobs", "thumbnailCacheSize", "pageFormat",
+                       "outputEncoding", "lazyLoad", "inputIndex", "serverAddress", "serverInputs", "serverCacheSize",
+                       "parseJobs", "modelCacheDir", "modelCacheSize", "outputCacheDir", "outputCacheSize")
+
+    def __init__(self, config: 'Config') -> None:
+        DiskCache.__init__(self, config.outputCacheDir, config.outputCacheSize * 1024 * 1024, ".out")
+        self.config = config
+
+    def get_key(self, layout: 'Layout') -> str:
+        """Finds the families of the layout, without building it, and
+        returns the key of its output."""
+        layout.get_sibling_families()
+        model = layout.model
+        templates = model.templates
+        digest = hashlib.sha256()
+        for family in sorted(layout.read_families, key=lambda i: i.fid or ""):
+            chil = model.chil_orders.get(family, family.chil)
+            husb = family.husb.iid if family.husb else None
+            wife = family.wife.iid if family.wife else None
+            digest.update(repr((family.fid, husb, wife, chil)).encode("utf-8"))
+        for iid in sorted(i for i in layout.get_dependencies() if i in model.individual_index):
+            individual = model.individual_index[iid]
+            famc = individual.famc.fid if individual.famc else None
+            fams = individual.fams.fid if individual.fams else None
+            picture = None  # type: Optional[Tuple[str, str, int, int]]
+            if self.config.images and not templates.anon_mode:
+                # Labels refer to the picture if it exists, with a path
+                # relative to the working directory in case the input is.
+                path = individual.get_picture_path()
+                try:
+                    stat = os.stat(path)
+                    picture = (path, os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    pass
+            digest.update(repr((iid, individual.sex, individual.forename, individual.surname, famc, fams,
+                                individual.birt, individual.deat, picture)).encode("utf-8"))
+        options = sorted((key, value) for key, value in self.config.option.items() if key not in OutputCache.ignored_options)
+        placeholder_dir = None
+        if self.config.images:
+            placeholder_dir = Individual.placeholderDir
+        return repr((OutputCache.version, options, placeholder_dir, digest.hexdigest()))
+
+    @staticmethod
+    def touch_thumbnails(layout: 'Layout', thumbnail_cache: ThumbnailCache) -> None:
+        """Marks the thumbnails a cached output refers to as recently used,
+        or creates them again in case they were removed since."""
+        model = layout.model
+        # Placeholder individuals are only created while building the layout.
+        pictures = {os.path.join(Individual.placeholderDir, "placeholder-%s.png" % i): "?" for i in "mfu"}
+        for iid in sorted(layout.get_dependencies()):
+            individual = model.individual_index.get(iid)
+            if individual:
+                pictures.setdefault(individual.get_label_picture(), individual.get_full_name())
+        for picture, full_name in pictures.items():
+            thumbnail_cache.get_picture(picture, full_name)
+
+    @staticmethod
+    def get_converted_key(key: str, converter: str) -> str:
+        """Returns the key of an output converted by converter, e.g. 'dot -Tsvg'."""
+        return repr((key, converter))
+
 
 # Configuration handling
 
@@ -885,12 +2398,16 @@ class Config:
             self.parser.read(path)
         self.option = {}  # type: Dict[str, Any]
         for entry in CONFIG_OPTIONS:
-            if entry[1] == 'str':
-                self.option[entry[0]] = self.get(entry[0], entry[2])
-            elif entry[1] == 'int':
-                self.option[entry[0]] = int(self.get(entry[0], entry[2]))
-            elif entry[1] == 'bool':
-                self.option[entry[0]] = (self.get(entry[0], entry[2]).lower() == "true")
+            self.option[entry[0]] = self.convert(entry[1], self.get(entry[0], entry[2]))
+
+    @staticmethod
+    def convert(value_type: str, value: str) -> Any:
+        """Converts the string value of an option to the option's type."""
+        if value_type == 'int':
+            return int(value)
+        if value_type == 'bool':
+            return value.lower() == "true"
+        return value
 
     @staticmethod
     def usage() -> None:
@@ -923,6 +2440,11 @@ CONFIG_OPTIONS = (
     ('input', 'str', "test.ged", "Input filename (GEDCOM file)"),
     ('rootFamily', 'str', Config.rootFamilyDefault, "Starting from family with this identifier"),
 
+    ('rootFamilies', 'str', '', """Comma-separated list of family identifiers or patterns like \"F1*\", \"*\" means all families.
+If not empty: save a chart for each of these families into outputDir, instead of rootFamily to the standard output."""),
+    ('outputDir', 'str', '.', "If rootFamilies is not empty: directory of the charts, named after the family identifiers."),
+    ('batchJobs', 'int', '1', "If rootFamilies is not empty: number of processes saving the charts."),
+
     ('considerAgeDead', 'int', "120", "Consider someone dead at this age: put a question mark if death date is missing."),
     ('anonMode', 'bool', 'False', "Anonymous mode: avoid any kind of sensitive data in the output."),
     ('images', 'bool', 'True', "Should the output contain images?"),
@@ -939,6 +2461,15 @@ Possible values: \"\" - don't convert
 to find pictures of geneweb (also set imageFormatCase to lower for geneweb images)
 """),
 
+    ('thumbnailCacheDir', 'str', '', """If images is True: directory where scaled pictures are stored, instead of next to the original ones.
+The original pictures are only opened again when they change. Empty means no caching."""),
+    ('thumbnailCacheSize', 'int', '256', "Size limit of thumbnailCacheDir in megabytes, least recently used entries are removed first."),
+
+    ('childOrderBirth', 'bool', 'False', """Order siblings by birth year, instead of keeping the order of the input.
+Shown husbs are still placed rightmost and shown wifes leftmost."""),
+
+    ('labelJobs', 'int', '1', "Number of threads used to prepare node labels, e.g. to scale pictures. Only worth it for charts with lots of pictures."),
+
     ('nodeLabelImage', 'str', Config.nodeLabelImageDefault, """If images is True: label text of nodes.
 Possible values: %(picture)s, %(surname)s, %(forename)s, %(birt)s and %(deat)s."""),
 
@@ -960,11 +2491,48 @@ Example: \"P526, P525\"."""),
 
     ('layout', 'str', '', "Currently supported: \"\" or Descendants"),
 
+    ('layoutMaxNodes', 'int', '0', """If not 0: the number of nodes the layout may have, estimated before building it.
+In case the estimate is more, then first the sibling depths, then layoutMaxDepth is reduced till it fits."""),
+
+    ('outputFormat', 'str', 'dot', """Format of the output. Possible values:
+                 \"dot\" - graphviz input
+                 \"svg\" - SVG, the nodes are positioned by ged2dot itself, without graphviz
+"""),
+
+    ('layoutPageDepth', 'int', '0', """If not 0, split the layout into pages, each showing this many generations.
+The first page is the normal output, the others are written to files named after pageFormat.
+Nodes shown on an other page are repeated as dashed stubs, labeled with their page number."""),
+    ('pageFormat', 'str', 'page%d.dot', """If layoutPageDepth is not 0: file name of the pages after the first one, %d is the page number.
+Relative to the directory of the output, in case that's a file.
+If rootFamilies is not empty: prefixed with the family identifier, e.g. F1-page2.dot in outputDir."""),
+
     ('inputEncoding', 'str', 'UTF-8', """encoding of the gedcom
 example \"UTF-8\" or \"ISO 8859-15\"."""),
 
     ('outputEncoding', 'str', 'UTF-8', """encoding of the output file
 should be UTF-8 for dot-files"""),
+
+    ('lazyLoad', 'bool', 'False', """Only parse the records of the input which are reachable from rootFamily.
+Faster for large input files when only a part of them is shown."""),
+
+    ('inputIndex', 'bool', 'False', """If lazyLoad is True: store the index of the records in a <input>.idx file,
+so that it's only created again when the input changes."""),
+
+    ('serverAddress', 'str', '', """If not empty: run as a server on this address, instead of writing the standard output.
+Either host:port, e.g. \"localhost:8000\", or unix:path for a Unix socket.
+GET /render?rootFamily=F1&layoutMaxDepth=3 returns the output, GET /metrics returns statistics."""),
+    ('serverInputs', 'str', '', "If serverAddress is not empty: comma-separated list of inputs to keep in memory, by default input."),
+    ('serverCacheSize', 'int', '64', "If serverAddress is not empty: size limit of the cached outputs in megabytes."),
+
+    ('parseJobs', 'int', '1', "Number of processes used to parse the input. Only worth it for large input files."),
+
+    ('modelCacheDir', 'str', '', """Directory where parsed input files are cached, so unchanged files are not parsed again.
+Empty means no caching."""),
+    ('modelCacheSize', 'int', '1024', "Size limit of modelCacheDir in megabytes, least recently used entries are removed first."),
+
+    ('outputCacheDir', 'str', '', """Directory where outputs are cached, keyed by the options and the records they depend on.
+Empty means no caching."""),
+    ('outputCacheSize', 'int', '256', "Size limit of outputCacheDir in megabytes, least recently used entries are removed first."),
 )
 
 
@@ -983,15 +2551,31 @@ def main() -> None:
         config.usage()
         sys.exit(0)
 
+    if config.serverAddress:
+        import ged2dot_server  # pylint: disable=import-outside-toplevel
+        ged2dot_server.RenderServer(config).serve()
+        return
+
     model = Model(config)
     try:
         model.load(config.input)
+    except GedcomParseError as parse_error:
+        sys.stderr.write("%s\n" % parse_error)
+        sys.exit(1)
     except (BaseException) as base_exception:
         sys.stderr.write("error in tree file:\n")
         raise base_exception
     if sys.version_info[0] < 3:
         sys.stdout = codecs.getwriter(config.outputEncoding)(sys.stdout)
-    model.save(sys.stdout)
+    try:
+        if config.rootFamilies:
+            model.save_batch()
+        else:
+            model.save(sys.stdout)
+    except GedcomParseError as parse_error:
+        # In case of lazy loading, records are only parsed while saving.
+        sys.stderr.write("%s\n" % parse_error)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,290 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import collections
+import http.server
+import io
+import mmap
+import os
+import socketserver
+import stat
+import sys
+import time
+import urllib.parse
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import Union
+from typing import cast
+
+import ged2dot
+
+
+def get_resident_size() -> int:
+    """Returns the resident memory size of the process in bytes, or 0 if it's not known."""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as stream:
+            return int(stream.read().split()[1]) * mmap.PAGESIZE
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class RenderCache:
+    """In-memory cache of rendered outputs, the least recently used ones are
+    removed when their total size would be more than limit bytes. Each output
+    has the IDs of the individuals and families it depends on."""
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.size = 0
+        self.entries = collections.OrderedDict()  # type: collections.OrderedDict[Tuple[Any, ...], Tuple[bytes, Set[str]]]
+
+    def get(self, key: Tuple[Any, ...]) -> Optional[bytes]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: Tuple[Any, ...], value: bytes, dependencies: Set[str]) -> None:
+        if len(value) > self.limit:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old[0])
+        self.entries[key] = (value, dependencies)
+        self.size += len(value)
+        while self.size > self.limit:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted[0])
+
+    def evict(self, name: str, touched: Optional[Set[str]] = None) -> None:
+        """Removes the outputs of the input name. In case touched is given,
+        only the outputs depending on one of these IDs are removed."""
+        for key in [i for i in self.entries if i[0] == name]:
+            if touched is not None and touched.isdisjoint(self.entries[key][1]):
+                continue
+            self.size -= len(self.entries.pop(key)[0])
+
+
+# Options which can be set per request. They only affect the layout, not the
+# parsed model or the node labels, so models can be shared between requests.
+# layoutMaxNodes can be only lowered, see RenderServer.get_options().
+SERVER_OPTIONS = ("rootFamily", "layout", "layoutMaxDepth", "layoutMaxSiblingDepth", "layoutMaxSiblingSpouseDepth",
+                  "layoutMaxSiblingFamilyDepth", "layoutMaxNodes", "childOrderBirth", "outputFormat")
+
+
+class RenderServer:
+    """Keeps the models of serverInputs in memory and renders them on
+    request, caching the results. A model is loaded again when its input
+    changes. Requests are handled one by one, as layouts change the model
+    temporarily."""
+    def __init__(self, config: ged2dot.Config) -> None:
+        self.config = config
+        self.inputs = [i.strip() for i in config.serverInputs.split(",") if i.strip()]
+        if not self.inputs:
+            self.inputs = [config.input]
+        # Input -> (mtime, size, resident size of the load, model).
+        self.models = {}  # type: Dict[str, Tuple[int, int, int, ged2dot.Model]]
+        self.cache = RenderCache(config.serverCacheSize * 1024 * 1024)
+        self.option_types = {i[0]: i[1] for i in ged2dot.CONFIG_OPTIONS}
+        self.metrics = collections.OrderedDict([
+            ("requests_total", 0),
+            ("request_errors_total", 0),
+            ("request_seconds_total", 0.0),
+            ("request_seconds_max", 0.0),
+            ("cache_hits_total", 0),
+            ("cache_misses_total", 0),
+            ("model_loads_total", 0),
+            ("model_reloads_total", 0),
+        ])  # type: collections.OrderedDict[str, Union[int, float]]
+
+    def get_model(self, name: str) -> ged2dot.Model:
+        """Returns the model of an input. If the input changed, only its
+        changed records are parsed again, and only the outputs depending on
+        them are removed from the cache. In case the input can't be parsed,
+        GedcomParseError is raised and the previous model is kept."""
+        stat_result = os.stat(name)
+        entry = self.models.get(name)
+        if entry and entry[0] == stat_result.st_mtime_ns and entry[1] == stat_result.st_size:
+            return entry[3]
+
+        if entry:
+            model = entry[3]
+            individuals, families = model.reload(name)
+            if individuals and model.templates.uses_gw_index:
+                # Labels depend on other individuals with the same name.
+                self.cache.evict(name)
+            else:
+                self.cache.evict(name, individuals | families)
+            self.models[name] = (stat_result.st_mtime_ns, stat_result.st_size, entry[2], model)
+            self.metrics["model_reloads_total"] += 1
+            return model
+
+        config = ged2dot.Config(self.config.config_dict)
+        config.option["input"] = name
+        before = get_resident_size()
+        model = ged2dot.Model(config)
+        model.load(name)
+        if not config.lazyLoad:
+            model.track_changes(name)
+        self.models[name] = (stat_result.st_mtime_ns, stat_result.st_size, max(get_resident_size() - before, 0), model)
+        self.metrics["model_loads_total"] += 1
+        return model
+
+    def get_options(self, query: Dict[str, List[str]]) -> Dict[str, Any]:
+        """Converts the options of a query, raises ValueError for invalid ones."""
+        options = {}  # type: Dict[str, Any]
+        for key, values in sorted(query.items()):
+            if key not in SERVER_OPTIONS:
+                raise ValueError("Unknown option '%s'" % key)
+            try:
+                options[key] = ged2dot.Config.convert(self.option_types[key], values[-1])
+            except ValueError as exception:
+                raise ValueError("Invalid option '%s': %s" % (key, exception)) from exception
+
+        if options.get("layout"):
+            layout = getattr(ged2dot, options["layout"] + "Layout", None)
+            if not isinstance(layout, type) or not issubclass(layout, ged2dot.Layout):
+                raise ValueError("Unknown layout '%s'" % options["layout"])
+        # The budget of the server can be lowered, but not raised or removed.
+        limit = self.config.layoutMaxNodes
+        if "layoutMaxNodes" in options and limit > 0:
+            if options["layoutMaxNodes"] <= 0:
+                options["layoutMaxNodes"] = limit
+            options["layoutMaxNodes"] = min(options["layoutMaxNodes"], limit)
+        return options
+
+    def render(self, query: Dict[str, List[str]]) -> Tuple[int, str, bytes]:
+        """Renders the input and options of a query, returns the HTTP status,
+        content type and body."""
+        name = query.pop("input", self.inputs[:1])[-1]
+        if name not in self.inputs:
+            return 404, "text/plain; charset=utf-8", ("Unknown input '%s'\n" % name).encode("utf-8")
+        try:
+            options = self.get_options(query)
+        except ValueError as exception:
+            return 400, "text/plain; charset=utf-8", ("%s\n" % exception).encode("utf-8")
+
+        model = self.get_model(name)
+        if options.get("outputFormat", model.config.outputFormat) == "svg":
+            content_type = "image/svg+xml"
+        else:
+            content_type = "text/vnd.graphviz"
+        cache_key = (name, tuple(sorted(options.items())))
+        body = self.cache.get(cache_key)
+        if body is not None:
+            self.metrics["cache_hits_total"] += 1
+            return 200, content_type, body
+        self.metrics["cache_misses_total"] += 1
+        out = io.StringIO()
+        try:
+            layout = model.save_with(out, options)
+        except (ged2dot.NoSuchFamilyException, ged2dot.NoSuchIndividualException) as exception:
+            return 404, "text/plain; charset=utf-8", ("%s\n" % exception).encode("utf-8")
+        body = out.getvalue().encode(model.config.outputEncoding)
+        self.cache.put(cache_key, body, layout.get_dependencies())
+        return 200, content_type, body
+
+    def get_metrics(self) -> str:
+        """Returns the metrics in the Prometheus text format."""
+        lines = []
+        for key, value in self.metrics.items():
+            lines.append("ged2dot_%s %s" % (key, value))
+        lines.append("ged2dot_cache_entries %s" % len(self.cache.entries))
+        lines.append("ged2dot_cache_bytes %s" % self.cache.size)
+        for name, (_, _, size, model) in sorted(self.models.items()):
+            label = '{input=%s}' % quote_metric_label(name)
+            lines.append("ged2dot_model_individuals%s %s" % (label, len(model.individuals)))
+            lines.append("ged2dot_model_families%s %s" % (label, len(model.families)))
+            lines.append("ged2dot_model_resident_bytes%s %s" % (label, size))
+        lines.append("ged2dot_resident_bytes %s" % get_resident_size())
+        return "\n".join(lines) + "\n"
+
+    def handle(self, path: str) -> Tuple[int, str, bytes]:
+        """Handles a request for path, returns the HTTP status, content type and body."""
+        start = time.perf_counter()
+        url = urllib.parse.urlsplit(path)
+        try:
+            if url.path == "/render":
+                ret = self.render(urllib.parse.parse_qs(url.query))
+            elif url.path == "/metrics":
+                ret = 200, "text/plain; version=0.0.4; charset=utf-8", self.get_metrics().encode("utf-8")
+            else:
+                ret = 404, "text/plain; charset=utf-8", b"Not found\n"
+        # pylint: disable=broad-except
+        except Exception as exception:
+            ret = 500, "text/plain; charset=utf-8", ("%s\n" % exception).encode("utf-8")
+        if ret[0] != 200:
+            self.metrics["request_errors_total"] += 1
+        seconds = time.perf_counter() - start
+        self.metrics["requests_total"] += 1
+        self.metrics["request_seconds_total"] += seconds
+        self.metrics["request_seconds_max"] = max(self.metrics["request_seconds_max"], seconds)
+        return ret
+
+    def make_server(self) -> socketserver.BaseServer:
+        """Creates the server listening on serverAddress: either host:port or unix:path."""
+        address = self.config.serverAddress
+        server = None  # type: Optional[socketserver.BaseServer]
+        if address.startswith("unix:"):
+            path = address[len("unix:"):]
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                # Left there by a previous server.
+                os.unlink(path)
+            server = socketserver.UnixStreamServer(path, RenderRequestHandler)
+        else:
+            host, _, port = address.rpartition(":")
+            server = http.server.HTTPServer((host or "localhost", int(port)), RenderRequestHandler)
+        setattr(server, "render_server", self)
+        return server
+
+    def serve(self) -> None:
+        """Loads the models, then serves requests till interrupted."""
+        for name in self.inputs:
+            try:
+                self.get_model(name)
+            except ged2dot.GedcomParseError as parse_error:
+                # Requests for this input fail till it's fixed.
+                sys.stderr.write("Failed to load '%s': %s\n" % (name, parse_error))
+        server = self.make_server()
+        sys.stderr.write("Listening on %s\n" % self.config.serverAddress)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if self.config.serverAddress.startswith("unix:"):
+                os.unlink(self.config.serverAddress[len("unix:"):])
+
+
+def quote_metric_label(value: str) -> str:
+    """Quotes a string for the label of a metric."""
+    return '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class RenderRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Passes GET requests to RenderServer."""
+    server_version = "ged2dot"
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        render_server = cast(RenderServer, getattr(self.server, "render_server"))
+        status, content_type, body = render_server.handle(self.path)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:  # pylint: disable=redefined-builtin
+        # The client address is empty for Unix sockets.
+        sys.stderr.write("%s\n" % (format % args))
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
@@ -6,29 +6,197 @@
 #
 
 import base64
+import collections
 import sys
-import xml.etree.ElementTree as ElementTree
-from typing import Union
+import xml.sax
+import xml.sax.handler
+import xml.sax.saxutils
+import xml.sax.xmlreader
+from typing import Any
+from typing import Callable
+from typing import Dict
 from typing import IO
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+from typing import cast
 
 NAMESPACES = {
     'svg': 'http://www.w3.org/2000/svg',
-    'xlink': 'http://www.w3.org/1999/xlink'
+    'xlink': 'http://www.w3.org/1999/xlink',
+    'xml': 'http://www.w3.org/XML/1998/namespace'
 }
 
+# Namespace and local name of an element or attribute.
+Name = Tuple[Optional[str], str]
+# Attributes of an image, except its position.
+ImageKey = Tuple[Tuple[Name, str], ...]
+
+IMAGE = (NAMESPACES['svg'], 'image')
+HREF = (NAMESPACES['xlink'], 'href')
+POSITION = ((None, 'x'), (None, 'y'))
+
+# Multiple of 3, so that the base64 encoding of chunks can be concatenated.
+CHUNK_SIZE = 3 * 16 * 1024
+
+
+def get_image_key(attrs: Any) -> ImageKey:
+    """Images which only differ in their position can share a single definition."""
+    items = [(name, value) for name, value in attrs.items() if name not in POSITION]
+    return tuple(sorted(items, key=lambda item: (item[0][0] or "", item[0][1])))
+
+
+class ImageCounter(xml.sax.handler.ContentHandler):
+    """Counts how many times the same image is used."""
+    def __init__(self) -> None:
+        xml.sax.handler.ContentHandler.__init__(self)
+        # Ordered by first occurrence, so definition IDs are the same on all
+        # Python versions.
+        self.counts = collections.OrderedDict()  # type: collections.OrderedDict[ImageKey, int]
+
+    # pylint: disable=invalid-name
+    def startElementNS(self, name: Name, _qname: Optional[str], attrs: Any) -> None:
+        if name == IMAGE:
+            key = get_image_key(attrs)
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+
+class Inlineizer(xml.sax.handler.ContentHandler):
+    """Copies the SVG to the output, while embedding images."""
+    def __init__(self, write: Callable[[bytes], Any], counts: Dict[ImageKey, int]) -> None:
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.write = write
+        self.counts = counts
+        # Image key -> ID of its definition, for images used multiple times.
+        self.definitions = collections.OrderedDict()  # type: collections.OrderedDict[ImageKey, str]
+        for key, count in counts.items():
+            if count > 1:
+                self.definitions[key] = "image%s" % len(self.definitions)
+        self.prefixes = {NAMESPACES['xml']: 'xml'}  # type: Dict[str, str]
+        self.pending_prefixes = []  # type: List[Tuple[str, str]]
+        self.depth = 0
+        self.in_image = False
+
+    def get_qname(self, name: Name) -> str:
+        uri, localname = name
+        prefix = self.prefixes.get(uri, "") if uri else ""
+        if prefix:
+            return "%s:%s" % (prefix, localname)
+        return localname
+
+    def write_text(self, text: str) -> None:
+        self.write(text.encode('utf-8'))
+
+    def write_start(self, name: Name, attrs: Sequence[Tuple[Name, str]], href: Optional[str] = None, empty: bool = False) -> None:
+        """Writes a start tag. In case href is provided, the content of that
+        file is written as a data URI, in chunks."""
+        self.write_text("<" + self.get_qname(name))
+        for prefix, uri in self.pending_prefixes:
+            if prefix:
+                self.write_text(" xmlns:%s=%s" % (prefix, xml.sax.saxutils.quoteattr(uri)))
+            else:
+                self.write_text(" xmlns=%s" % xml.sax.saxutils.quoteattr(uri))
+        self.pending_prefixes = []
+        for attr_name, value in attrs:
+            self.write_text(" %s=%s" % (self.get_qname(attr_name), xml.sax.saxutils.quoteattr(value)))
+        if href is not None:
+            self.write_text(' %s="data:image/png;base64,' % self.get_qname(HREF))
+            with open(href, 'rb') as sock:
+                while True:
+                    chunk = sock.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.write(base64.b64encode(chunk))
+            self.write_text('"')
+        if empty:
+            self.write_text("/>")
+        else:
+            self.write_text(">")
+
+    def write_definitions(self) -> None:
+        if not self.definitions:
+            return
+        self.write_text("<%s>" % self.get_qname((NAMESPACES['svg'], 'defs')))
+        for key, id_string in self.definitions.items():
+            attrs = [((None, 'id'), id_string)]  # type: List[Tuple[Name, str]]
+            attrs += [i for i in key if i[0] != HREF]
+            self.write_start(IMAGE, attrs, href=dict(key)[HREF], empty=True)
+        self.write_text("</%s>" % self.get_qname((NAMESPACES['svg'], 'defs')))
+
+    # pylint: disable=invalid-name
+    def startPrefixMapping(self, prefix: Optional[str], uri: str) -> None:
+        self.prefixes[uri] = prefix or ""
+        self.pending_prefixes.append((prefix or "", uri))
+
+    def startElementNS(self, name: Name, _qname: Optional[str], attrs: Any) -> None:
+        self.depth += 1
+        if name != IMAGE:
+            self.write_start(name, list(attrs.items()))
+            if self.depth == 1:
+                self.write_definitions()
+            return
+
+        self.in_image = True
+        key = get_image_key(attrs)
+        if key in self.definitions:
+            use = [(HREF, "#%s" % self.definitions[key])]  # type: List[Tuple[Name, str]]
+            use += [(i, attrs[i]) for i in POSITION if i in attrs]
+            self.write_start((NAMESPACES['svg'], 'use'), use, empty=True)
+        else:
+            image = [(i, j) for i, j in attrs.items() if i != HREF]
+            self.write_start(name, image, href=attrs[HREF], empty=True)
+
+    def endElementNS(self, name: Name, _qname: Optional[str]) -> None:
+        self.depth -= 1
+        if name == IMAGE:
+            self.in_image = False
+            return
+        self.write_text("</%s>" % self.get_qname(name))
+
+    def characters(self, content: str) -> None:
+        if self.in_image:
+            # Images are written as empty elements.
+            return
+        self.write_text(xml.sax.saxutils.escape(content))
+
+
+def parse(from_stream: IO[bytes], handler: xml.sax.handler.ContentHandler) -> None:
+    # Feed the parser manually: parse() would close from_stream.
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_namespaces, True)
+    parser.setFeature(xml.sax.handler.feature_external_ges, False)
+    parser.setContentHandler(handler)
+    while True:
+        chunk = from_stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        cast(xml.sax.xmlreader.IncrementalParser, parser).feed(chunk)
+    cast(xml.sax.xmlreader.IncrementalParser, parser).close()
+
 
 def inlineize(from_path: Union[str, IO[bytes]], to_path: Union[str, IO[bytes]]) -> None:
-    ElementTree.register_namespace('', NAMESPACES['svg'])
-    ElementTree.register_namespace('xlink', NAMESPACES['xlink'])
-    tree = ElementTree.ElementTree()
-    tree.parse(from_path)
-    for image in tree.findall('.//{%s}image' % NAMESPACES['svg']):
-        xlinkhref = '{%s}href' % NAMESPACES['xlink']
-        href = image.attrib[xlinkhref]
-        sock = open(href, 'rb')
-        image.attrib[xlinkhref] = "data:image/png;base64,%s" % base64.b64encode(sock.read()).decode('ascii')
-        sock.close()
-    tree.write(to_path)
+    """Embeds the images of an SVG file. Works in a streaming way, so the
+    document is never kept in memory. Images used multiple times are embedded
+    only once."""
+    if isinstance(from_path, str):
+        with open(from_path, 'rb') as stream:
+            inlineize(stream, to_path)
+        return
+    if isinstance(to_path, str):
+        with open(to_path, 'wb') as stream:
+            inlineize(from_path, stream)
+        return
+
+    # First pass: find out which images are used multiple times.
+    start = from_path.tell()
+    counter = ImageCounter()
+    parse(from_path, counter)
+    from_path.seek(start)
+
+    # Second pass: write the output.
+    parse(from_path, Inlineizer(to_path.write, counter.counts))
 
 
 def main() -> None:
@@ -8,11 +8,13 @@
 import glob
 import io
 import os
+import shutil
 import subprocess
 import sys
 from typing import Any
 from typing import Dict
 from typing import Iterable
+from typing import Optional
 from typing import Tuple
 
 import uno  # type: ignore  # Cannot find module named 'uno'
@@ -36,10 +38,33 @@ class GedcomImport(unohelper.Base, XFilter, XImporter, XExtendedFilterDetection,
         self.props = {}  # type: Dict[str, Any]
         self.dst_doc = None
 
+    @staticmethod
+    def __find_dot() -> Optional[str]:
+        """Returns the path of graphviz's dot, if it's installed."""
+        if sys.platform.startswith("win"):
+            pattern = os.environ['PROGRAMFILES'] + '\\Graphviz*\\bin\\dot.exe'
+            dot_paths = glob.glob(pattern)
+            if not dot_paths and 'PROGRAMFILES(x86)' in os.environ.keys():
+                pattern = os.environ['PROGRAMFILES(x86)'] + '\\Graphviz*\\bin\\dot.exe'
+                dot_paths = glob.glob(pattern)
+            if not dot_paths:
+                return None
+            return dot_paths[-1]
+        return shutil.which("dot")
+
+    @staticmethod
+    def __get_dot_version(dot_path: Optional[str]) -> str:
+        """Returns the version of graphviz's dot, renders of other versions are not reused."""
+        if not dot_path:
+            return ""
+        return subprocess.check_output([dot_path, '-V'], stderr=subprocess.STDOUT).decode('utf-8', 'replace').strip()
+
     def __to_svg(self, ged: str) -> bytes:
         root_family = ged2dot.Config.rootFamilyDefault
         layout_max_depth = ged2dot.Config.layoutMaxDepthDefault
         node_label_image = ged2dot.Config.nodeLabelImageDefault
+        # Caching is opt-in, the outputs are only written to disk if this is set.
+        output_cache_dir = ""
         if "FilterData" in self.props.keys():
             filter_data = self.to_dict(self.props["FilterData"])
             if "rootFamily" in filter_data.keys():
@@ -48,44 +73,54 @@ class GedcomImport(unohelper.Base, XFilter, XImporter, XExtendedFilterDetection,
                 layout_max_depth = filter_data["layoutMaxDepth"]
             if "nodeLabelImage" in filter_data.keys():
                 node_label_image = filter_data["nodeLabelImage"]
+            if "outputCacheDir" in filter_data.keys():
+                output_cache_dir = filter_data["outputCacheDir"]
         config_dict = {
             'ged2dot': {
                 'input': ged,
                 'rootFamily': root_family,
                 'layoutMaxDepth': layout_max_depth,
-                'nodeLabelImage': node_label_image
+                'nodeLabelImage': node_label_image,
+                'outputCacheDir': output_cache_dir
             }
         }
+        dot_path = self.__find_dot()
+        if not dot_path:
+            # Without graphviz, let ged2dot position the nodes.
+            config_dict['ged2dot']['outputFormat'] = 'svg'
         config = ged2dot.Config(config_dict)
         model = ged2dot.Model(config)
         model.load(config.input)
         dot = io.StringIO()
-        model.save(dot)
+        layout = model.save(dot)
+        # Graphviz and inlining the pictures are the slow part, cache their result as well.
+        cache = None
+        if layout.output_key:
+            cache = ged2dot.OutputCache(config)
+            converter = "inlineize %s -Tsvg %s" % (dot_path, self.__get_dot_version(dot_path))
+            key = cache.get_converted_key(layout.output_key, converter)
+            cached = cache.read(key)
+            if cached is not None:
+                return cached
 
-        if sys.platform.startswith("win"):
-            pattern = os.environ['PROGRAMFILES'] + '\\Graphviz*\\bin\\dot.exe'
-            dot_paths = glob.glob(pattern)
-            if not dot_paths and 'PROGRAMFILES(x86)' in os.environ.keys():
-                pattern = os.environ['PROGRAMFILES(x86)'] + '\\Graphviz*\\bin\\dot.exe'
-                dot_paths = glob.glob(pattern)
-            if not dot_paths:
-                raise Exception("No dot.exe found at '%s', please download it from <https://graphviz.gitlab.io/_pages/Download/Download_windows.html>." % pattern)
-            dot_path = dot_paths[-1]
-        else:
-            dot_path = "dot"
-        graphviz = subprocess.Popen([dot_path, '-Tsvg'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        dot.seek(0)
-        graphviz.stdin.write(dot.read().encode('utf-8'))
-        graphviz.stdin.close()
         noinline = io.BytesIO()
-        noinline.write(graphviz.stdout.read())
-        graphviz.stdout.close()
-        graphviz.wait()
+        if dot_path:
+            graphviz = subprocess.Popen([dot_path, '-Tsvg'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            dot.seek(0)
+            graphviz.stdin.write(dot.read().encode('utf-8'))
+            graphviz.stdin.close()
+            noinline.write(graphviz.stdout.read())
+            graphviz.stdout.close()
+            graphviz.wait()
+        else:
+            noinline.write(dot.getvalue().encode('utf-8'))
 
         noinline.seek(0)
         inline = io.BytesIO()
         inlineize.inlineize(noinline, inline)
 
+        if cache:
+            cache.write(key, inline.getvalue())
         inline.seek(0)
         return inline.read()
 
@@ -5,22 +5,29 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 #
 
+import base64
+import http.client
+import importlib.util
 import io
+import json
 import os
+import pickle
+import shutil
 import sys
+import tempfile
+import threading
 import unittest
 import unittest.mock
+import xml.etree.ElementTree as ElementTree
 from typing import Any
+from typing import Dict
 from typing import List
+from typing import Set
+from typing import Tuple
 from typing import cast
 import ged2dot
-
-
-def mock_sys_exit(ret: List[int]) -> Any:
-    """Mocks sys.exit()."""
-    def mock(code: int) -> None:
-        ret.append(code)
-    return mock
+import ged2dot_server
+import inlineize
 
 
 class Test(unittest.TestCase):
@@ -63,24 +70,280 @@ class Test(unittest.TestCase):
         self.assertTrue("None" not in indi.get_label())
 
     def test_nosex(self) -> None:
-        # Capture standard output.
-        buf = io.StringIO()
-        with unittest.mock.patch('sys.stderr', buf):
-            ret = []  # type: List[int]
-            with unittest.mock.patch('sys.exit', mock_sys_exit(ret)):
-                # if there is no sex, this should fail and indicate line number
-                config_dict = {
-                    'ged2dot': {
-                        'input': 'nosex.ged',
-                        'rootFamily': 'F1'
-                    }
+        # if there is no sex, this should fail and indicate line number
+        config_dict = {
+            'ged2dot': {
+                'input': 'nosex.ged',
+                'rootFamily': 'F1'
+            }
+        }
+        with self.assertRaises(ged2dot.GedcomParseError) as context:
+            self.convert('nosex', config_dict)
+        expected = "Encountered parsing error in .ged: list index out of range\n"
+        expected += "line (12): 1 SEX"
+        self.assertEqual(str(context.exception), expected)
+
+    def test_parse_streaming(self) -> None:
+        # Records are yielded at level 0 boundaries, without reading the rest of the input.
+        config = ged2dot.Config({'ged2dot': {}})
+        model = ged2dot.Model(config)
+        inf = open("hello.ged", "rb")
+        records = ged2dot.GedcomImport(inf, model).parse()
+        indi = next(records)
+        assert isinstance(indi, ged2dot.Individual)
+        self.assertEqual(indi.iid, "P1")
+        self.assertEqual(indi.forename, "Alice")
+        self.assertFalse(model.individuals)
+        self.assertEqual([i.iid if isinstance(i, ged2dot.Individual) else i.fid for i in records], ["P2", "F1"])
+        inf.close()
+
+    def test_compact_records(self) -> None:
+        # Records have no per-instance dict and share their ID strings.
+        model = self.convert('screenshot', {'ged2dot': {'input': 'screenshot.ged', 'rootFamily': 'F1', 'images': False}})
+        for record in model.individuals + model.families:
+            self.assertFalse(hasattr(record, "__dict__"))
+            self.assertIs(record.model, model)
+        family = model.get_family("F9")
+        assert family and family.chil
+        self.assertIs(type(family), ged2dot.Family)
+        for chil in family.chil:
+            individual = model.get_individual(chil)
+            assert individual
+            self.assertIs(type(individual), ged2dot.Individual)
+            self.assertIs(individual.iid, chil)
+
+        # Smaller than the same attributes in a per-instance dict.
+        class Plain:
+            pass
+        plain = Plain()
+        for key in ged2dot.Individual.__slots__:
+            setattr(plain, key, getattr(individual, key))
+        self.assertLess(sys.getsizeof(individual), sys.getsizeof(plain) + sys.getsizeof(plain.__dict__))
+
+    def test_model_cache(self) -> None:
+        # The second load is served from the cache, without parsing the input again.
+        with tempfile.TemporaryDirectory() as cache_dir:
+            config_dict = {
+                'ged2dot': {
+                    'input': 'screenshot.ged',
+                    'rootFamily': 'F1',
+                    'modelCacheDir': cache_dir
                 }
-                self.convert('nosex', config_dict)
-                self.assertEqual(ret, [1])
-                buf.seek(0)
-                expected = "Encountered parsing error in .ged: list index out of range\n"
-                expected += "line (12): 1 SEX\n"
-                self.assertEqual(buf.read(), expected)
+            }
+            self.convert('screenshot', config_dict)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            with open("screenshot.dot") as stream:
+                expected = stream.read()
+            with unittest.mock.patch('ged2dot.GedcomImport.load', side_effect=AssertionError("parsed again")):
+                self.convert('screenshot', config_dict)
+            with open("screenshot.dot") as stream:
+                self.assertEqual(stream.read(), expected)
+
+    def test_lazy_load(self) -> None:
+        # Lazy loading gives the same output, but parses only the reachable records.
+        config_dict = {
+            'ged2dot': {
+                'input': 'screenshot.ged',
+                'rootFamily': 'F1',
+                'layoutMaxDepth': 1
+            }
+        }
+        self.convert('screenshot', config_dict)
+        with open("screenshot.dot") as stream:
+            expected = stream.read()
+        config_dict['ged2dot']['lazyLoad'] = True
+        model = self.convert('screenshot', config_dict)
+        with open("screenshot.dot") as stream:
+            self.assertEqual(stream.read(), expected)
+        self.assertEqual(len(model.individuals), 11)
+        self.assertIsNone(model.get_individual("P999"))
+
+    def test_input_index(self) -> None:
+        # The index is written next to the input and is reused while the input is unchanged.
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ged = os.path.join(temp_dir, "hello.ged")
+            shutil.copyfile("hello.ged", ged)
+            config = ged2dot.Config({'ged2dot': {'input': ged, 'lazyLoad': True, 'inputIndex': True}})
+            ged2dot.Model(config).load(ged)
+            self.assertTrue(os.path.exists(ged + ".idx"))
+            index = ged2dot.GedcomIndex(ged, "UTF-8")
+            self.assertTrue(index.read())
+            self.assertEqual(index.surnames, {"A": ["P1"], "B": ["P2"]})
+            self.assertEqual(index.records["F1"][2], 10)
+            with unittest.mock.patch('ged2dot.GedcomIndex.build', side_effect=AssertionError("indexed again")):
+                model = ged2dot.Model(config)
+                model.load(ged)
+            family = model.get_family("F1")
+            assert family
+            self.assertEqual(family.husb.forename, "Bob")
+
+            # Index files are never unpickled, and malformed ones are ignored.
+            with open(ged + ".idx", "wb") as stream:
+                stream.write(pickle.dumps((index.get_key(), index.records, index.surnames)))
+            self.assertFalse(ged2dot.GedcomIndex(ged, "UTF-8").read())
+            with open(ged + ".idx", "w", encoding="utf-8") as stream:
+                stream.write(json.dumps(list(index.get_key())) + '\n{"ids": ["F1"], "surnames": {}}\n')
+            self.assertFalse(ged2dot.GedcomIndex(ged, "UTF-8").read())
+
+    def test_parse_jobs(self) -> None:
+        # Chunks start at level 0 lines and know their line number.
+        with open("hello.ged", "rb") as stream:
+            content = stream.read()
+        chunks = ged2dot.Model.split_input(content, 3)
+        self.assertEqual([content[start:start + 2] for start, _end, _line in chunks], [b"0 "] * 3)
+        self.assertEqual([line for _start, _end, line in chunks], [1, 6, 10])
+        self.assertEqual(chunks[-1][1], len(content))
+
+        # Parallel parsing gives the same result.
+        config_dict = {
+            'ged2dot': {
+                'input': 'screenshot.ged',
+                'rootFamily': 'F1'
+            }
+        }
+        self.convert('screenshot', config_dict)
+        with open("screenshot.dot") as stream:
+            expected = stream.read()
+        config_dict['ged2dot']['parseJobs'] = '2'
+        self.convert('screenshot', config_dict)
+        with open("screenshot.dot") as stream:
+            self.assertEqual(stream.read(), expected)
+
+    def test_gene_web_index(self) -> None:
+        # The index is the position of the ID among the sorted IDs of individuals with the same name.
+        model = ged2dot.Model(ged2dot.Config({'ged2dot': {}}))
+        for iid in ("P3", "P1", "P2"):
+            individual = ged2dot.Individual(model)
+            individual.iid = iid
+            individual.forename = "John"
+            individual.surname = "Smith"
+            model.add_individual(individual)
+        self.assertEqual(model.get_individual_gene_web_index("P2", "John", "Smith"), 1)
+        # Individuals added later are still taken into account.
+        individual = ged2dot.Individual(model)
+        individual.iid = "P0"
+        individual.forename = "John"
+        individual.surname = "Smith"
+        model.add_individual(individual)
+        self.assertEqual(model.get_individual_gene_web_index("P2", "John", "Smith"), 2)
+        with self.assertRaises(ValueError):
+            model.get_individual_gene_web_index("P2", "Jane", "Smith")
+
+    @unittest.skipIf(importlib.util.find_spec("PIL") is None, "PIL is not available")
+    def test_thumbnail_cache(self) -> None:
+        from PIL import Image  # type: ignore  # No library stub file for module
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config = ged2dot.Config({'ged2dot': {'thumbnailCacheDir': os.path.join(temp_dir, "cache")}})
+            cache = ged2dot.ThumbnailCache(config)
+            large = os.path.join(temp_dir, "large.png")
+            Image.new("RGB", (200, 150)).save(large)
+            small = os.path.join(temp_dir, "small.png")
+            Image.new("RGB", (100, 100)).save(small)
+
+            buf = io.StringIO()
+            with unittest.mock.patch('sys.stderr', buf):
+                thumbnail = cache.get_picture(large, "John Smith")
+            self.assertNotEqual(thumbnail, large)
+            with Image.open(thumbnail) as image:
+                self.assertEqual(image.size, (100, 75))
+            self.assertEqual(cache.get_picture(small, "Jane Smith"), small)
+
+            # Unchanged pictures are not opened again.
+            with unittest.mock.patch('PIL.Image.open', side_effect=AssertionError("opened again")):
+                self.assertEqual(cache.get_picture(large, "John Smith"), thumbnail)
+                self.assertEqual(cache.get_picture(small, "Jane Smith"), small)
+            # The source was not touched.
+            self.assertEqual(sorted(os.listdir(temp_dir)), ["cache", "large.png", "small.png"])
+
+    def test_label_jobs(self) -> None:
+        # Labels prepared in parallel give the same output.
+        config_dict = {
+            'ged2dot': {
+                'input': 'screenshot.ged',
+                'rootFamily': 'F1'
+            }
+        }
+        self.convert('screenshot', config_dict)
+        with open("screenshot.dot") as stream:
+            expected = stream.read()
+        config_dict['ged2dot']['labelJobs'] = '4'
+        get_shown_picture = getattr(ged2dot.Individual, "_Individual__get_shown_picture")
+        with unittest.mock.patch.object(ged2dot.Individual, "_Individual__get_shown_picture", autospec=True, side_effect=get_shown_picture) as mock:
+            model = self.convert('screenshot', config_dict)
+        with open("screenshot.dot") as stream:
+            self.assertEqual(stream.read(), expected)
+        # Shared pictures, e.g. placeholders, are only scaled once.
+        pictures = [i[0][1] for i in mock.call_args_list]
+        self.assertEqual(len(pictures), len(set(pictures)))
+        self.assertIn(os.path.join(ged2dot.Individual.placeholderDir, "placeholder-m.png"), pictures)
+        indi = model.get_individual("P48")
+        assert indi
+        self.assertEqual(model.labels[indi], indi.get_label())
+
+    def test_save_with_templates(self) -> None:
+        # Overwritten label options are used for that save only, despite the prepared labels.
+        config = ged2dot.Config({'ged2dot': {'input': 'screenshot.ged', 'rootFamily': 'F1', 'images': False}})
+        model = ged2dot.Model(config)
+        model.load(config.input)
+        expected = io.StringIO()
+        model.save(expected)
+        out = io.StringIO()
+        model.save_with(out, {'nodeLabelPlain': '"%(surname)s"', 'edgeInvisibleRed': True})
+        self.assertIn('label = "Smith"', out.getvalue())
+        self.assertIn("[ color = red ]", out.getvalue())
+        out = io.StringIO()
+        model.save(out)
+        self.assertEqual(out.getvalue(), expected.getvalue())
+
+    def test_inlineize_dedup(self) -> None:
+        # Repeated images are embedded once, and referenced from each position.
+        placeholder = os.path.join(ged2dot.Individual.placeholderDir, "placeholder-m.png")
+        image = '<image xlink:href="%s" width="100px" height="100px" preserveAspectRatio="xMinYMin meet" x="%s" y="-200"/>'
+        svg = '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink"><g>%s</g><g>%s</g></svg>'
+        from_stream = io.BytesIO((svg % (image % (placeholder, 10), image % (placeholder, 120))).encode('utf-8'))
+        to_stream = io.BytesIO()
+        inlineize.inlineize(from_stream, to_stream)
+        to_stream.seek(0)
+        root = ElementTree.parse(to_stream).getroot()
+        svg_ns = '{http://www.w3.org/2000/svg}'
+        xlink_href = '{http://www.w3.org/1999/xlink}href'
+        images = root.findall('.//%simage' % svg_ns)
+        self.assertEqual(len(images), 1)
+        self.assertTrue(images[0].attrib[xlink_href].startswith("data:image/png;base64,"))
+        self.assertEqual(images[0].attrib['width'], "100px")
+        uses = root.findall('.//%suse' % svg_ns)
+        self.assertEqual([(i.attrib[xlink_href], i.attrib['x']) for i in uses], [("#image0", "10"), ("#image0", "120")])
+
+    def test_inlineize_stream(self) -> None:
+        # The SAX path copies the document, embeds a picture larger than a
+        # chunk and keeps the input stream open.
+        with tempfile.TemporaryDirectory() as temp_dir:
+            picture = os.path.join(temp_dir, "large.png")
+            content = bytes(range(256)) * (inlineize.CHUNK_SIZE // 256 + 7)
+            with open(picture, "wb") as stream:
+                stream.write(content)
+            svg = ('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">'
+                   '<title>A &amp; B &lt;C&gt;</title>'
+                   '<g id="a"><image xlink:href="%s" width="100px" height="100px" x="1" y="2"/></g>'
+                   '<use xlink:href="#a" x="5"/></svg>') % picture
+            from_stream = io.BytesIO(svg.encode('utf-8'))
+            to_stream = io.BytesIO()
+            inlineize.inlineize(from_stream, to_stream)
+            self.assertFalse(from_stream.closed)
+        to_stream.seek(0)
+        root = ElementTree.parse(to_stream).getroot()
+        svg_ns = '{http://www.w3.org/2000/svg}'
+        xlink_href = '{http://www.w3.org/1999/xlink}href'
+        self.assertEqual(root.findtext('%stitle' % svg_ns), "A & B <C>")
+        # Used once: embedded in place, no definition.
+        self.assertIsNone(root.find('%sdefs' % svg_ns))
+        images = root.findall('.//%simage' % svg_ns)
+        self.assertEqual(len(images), 1)
+        self.assertEqual(images[0].attrib[xlink_href], "data:image/png;base64," + base64.b64encode(content).decode('ascii'))
+        self.assertEqual((images[0].attrib['x'], images[0].attrib['y']), ("1", "2"))
+        # A use element of the input is copied as-is.
+        uses = root.findall('%suse' % svg_ns)
+        self.assertEqual([(i.attrib[xlink_href], i.attrib['x']) for i in uses], [("#a", "5")])
 
     def test_husbcousin(self) -> None:
         # Layout failed when handling cousins on the left edge of the layout.
@@ -119,7 +382,11 @@ class Test(unittest.TestCase):
                 'rootFamily': 'F3'
             }
         }
-        self.convert('nohusb', config_dict)
+        model = self.convert('nohusb', config_dict)
+        # Placeholders are also available via the ID lookup.
+        family = model.get_family("F1")
+        assert family
+        self.assertEqual(model.get_individual(family.husb.iid), family.husb)
 
     def test_nowife(self) -> None:
         # This tests if placeholder nodes are created for missing wifes.
@@ -164,6 +431,537 @@ class Test(unittest.TestCase):
                     node = cast(ged2dot.Node, element)
                     self.assertTrue(node.node_id != "p9")
 
+    def test_layout_pages(self) -> None:
+        """Test that each page only refers to nodes which are either on that page or are stubs."""
+        with tempfile.TemporaryDirectory() as tmp:
+            config_dict = {
+                'ged2dot': {
+                    'input': 'screenshot.ged',
+                    'rootFamily': 'F1',
+                    'layoutPageDepth': 2,
+                    'pageFormat': os.path.join(tmp, 'page%d.dot')
+                }
+            }
+            self.convert('screenshot', config_dict)
+            # The 4th page would have no nodes.
+            self.assertEqual(sorted(os.listdir(tmp)), ["page2.dot", "page3.dot"])
+            paths = ["screenshot.dot"] + [os.path.join(tmp, "page%d.dot" % i) for i in range(2, 4)]
+            for path in paths:
+                with open(path) as stream:
+                    lines = stream.read().splitlines()
+                self.assertEqual(lines[0], "digraph tree {")
+                nodes = set()  # type: Set[str]
+                endpoints = set()  # type: Set[str]
+                for line in lines[1:]:
+                    tokens = line.split()
+                    if len(tokens) > 2 and tokens[1] == "->":
+                        endpoints.update((tokens[0], tokens[2]))
+                    elif tokens and tokens[0].startswith("P"):
+                        nodes.add(tokens[0])
+                self.assertTrue(endpoints)
+                self.assertFalse({i for i in endpoints if i.startswith("P")} - nodes)
+            with open(paths[1]) as stream:
+                self.assertIn('xlabel = "page 1"', stream.read())
+
+    def test_layout_pages_relative(self) -> None:
+        """Test that a relative pageFormat is relative to the output file."""
+        config_dict = {
+            'ged2dot': {
+                'input': 'screenshot.ged',
+                'rootFamily': 'F1',
+                'layoutPageDepth': 2,
+            }
+        }
+        config = ged2dot.Config(config_dict)
+        model = ged2dot.Model(config)
+        model.load(config.input)
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "screenshot.dot"), "w") as stream:
+                model.save(stream)
+            self.assertEqual(sorted(os.listdir(tmp)), ["page2.dot", "page3.dot", "screenshot.dot"])
+
+    def test_layout_pages_batch(self) -> None:
+        """Test that the pages of batch charts are written next to them, named after their family."""
+        with tempfile.TemporaryDirectory() as tmp:
+            config_dict = {
+                'ged2dot': {
+                    'input': 'screenshot.ged',
+                    'rootFamilies': 'F1,F10',
+                    'outputDir': tmp,
+                    'layoutPageDepth': 2,
+                }
+            }
+            config = ged2dot.Config(config_dict)
+            model = ged2dot.Model(config)
+            model.load(config.input)
+            cwd = os.listdir(".")
+            model.save_batch()
+            self.assertEqual(os.listdir("."), cwd)
+            files = sorted(os.listdir(tmp))
+            self.assertEqual(files, ["F1-page2.dot", "F1-page3.dot", "F1.dot", "F10-page2.dot", "F10-page3.dot", "F10.dot"])
+            with open(os.path.join(tmp, "F10-page2.dot")) as stream:
+                self.assertIn('xlabel = "page 1"', stream.read())
+
+    def test_layout_pages_svg(self) -> None:
+        """Test that paging is rejected for SVG output."""
+        config_dict = {
+            'ged2dot': {
+                'input': 'screenshot.ged',
+                'rootFamily': 'F1',
+                'layoutPageDepth': 2,
+                'outputFormat': 'svg',
+            }
+        }
+        config = ged2dot.Config(config_dict)
+        model = ged2dot.Model(config)
+        model.load(config.input)
+        with self.assertRaises(ValueError):
+            model.save(io.StringIO())
+
+    def test_layout_max_nodes(self) -> None:
+        """Test that the layout depths are reduced to fit layoutMaxNodes."""
+        config_dict = {
+            'ged2dot': {
+                'input': 'screenshot.ged',
+                'rootFamily': 'F1',
+                'layoutMaxNodes': 100
+            }
+        }
+        with unittest.mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            model = self.convert('screenshot', config_dict)
+            self.assertIn("more than layoutMaxNodes (100)", stderr.getvalue())
+            layout = model.save(io.StringIO())
+        self.assertEqual(layout.depths["layoutMaxDepth"], 2)
+        self.assertEqual(layout.depths["layoutMaxSiblingFamilyDepth"], 0)
+        # The reduction is for that save only.
+        self.assertEqual(model.config.layoutMaxDepth, 5)
+        self.assertEqual(model.config.layoutMaxSiblingFamilyDepth, 1)
+        model.config.option.update(layout.depths)
+        layout = ged2dot.Layout(model, io.StringIO())
+        nodes, _edges = layout.estimate()
+        self.assertLessEqual(nodes, 100)
+        layout.calc()
+        self.assertEqual(nodes, sum(len(i) for subgraph in layout.subgraphs for i in subgraph.nodes.values()))
+
+    def test_svg_output(self) -> None:
+        """Test that the SVG output has a box for each individual, and boxes in a row don't overlap."""
+        config_dict = {
+            'ged2dot': {
+                'input': 'screenshot.ged',
+                'rootFamily': 'F1',
+                'outputFormat': 'svg'
+            }
+        }
+        self.convert('screenshot', config_dict)
+        svg = ElementTree.parse("screenshot.dot").getroot()
+        namespace = "{http://www.w3.org/2000/svg}"
+        self.assertEqual(svg.tag, namespace + "svg")
+        rows = {}  # type: Dict[float, List[Tuple[float, float]]]
+        for rect in svg.iter(namespace + "rect"):
+            rows.setdefault(float(rect.get("y", "0")) + float(rect.get("height", "0")) / 2, []).append((float(rect.get("x", "0")), float(rect.get("width", "0"))))
+        self.assertEqual(sum(len(i) for i in rows.values()), len(svg.findall(".//%sg[@class='node']" % namespace)))
+        self.assertEqual(len(rows), 4)
+        for row in rows.values():
+            row.sort()
+            for (left_x, left_width), (right_x, _right_width) in zip(row, row[1:]):
+                self.assertLess(left_x + left_width, right_x)
+        self.assertEqual(len(svg.findall(".//%simage" % namespace)), sum(len(i) for i in rows.values()))
+
+    def test_batch(self) -> None:
+        """Test that batch mode writes the same charts as separate runs, with one or more processes."""
+        for jobs in (1, 2):
+            with tempfile.TemporaryDirectory() as tmp:
+                config_dict = {
+                    'ged2dot': {
+                        'input': 'screenshot.ged',
+                        'rootFamilies': 'F1, F15*',
+                        'outputDir': tmp,
+                        'batchJobs': jobs
+                    }
+                }
+                config = ged2dot.Config(config_dict)
+                model = ged2dot.Model(config)
+                model.load(config.input)
+                self.assertEqual(model.get_root_families(), ["F152", "F153", "F154", "F157", "F1"])
+                model.save_batch()
+                for fid in ("F1", "F152"):
+                    self.convert('screenshot', {'ged2dot': {'input': 'screenshot.ged', 'rootFamily': fid}})
+                    with open("screenshot.dot") as expected, open(os.path.join(tmp, fid + ".dot")) as actual:
+                        self.assertEqual(actual.read(), expected.read())
+
+    def test_batch_placeholders(self) -> None:
+        """Test that the placeholders of a chart don't change the next one, and
+        that failed charts leave no output behind."""
+        with tempfile.TemporaryDirectory() as tmp:
+            config_dict = {
+                'ged2dot': {
+                    'input': 'nohusb.ged',
+                    'rootFamilies': 'F*',
+                    'outputDir': tmp,
+                }
+            }
+            config = ged2dot.Config(config_dict)
+            model = ged2dot.Model(config)
+            model.load(config.input)
+            model.save_batch()
+            for fid in ("F1", "F2", "F3"):
+                self.convert('nohusb', {'ged2dot': {'input': 'nohusb.ged', 'rootFamily': fid}})
+                with open("nohusb.dot") as expected, open(os.path.join(tmp, fid + ".dot")) as actual:
+                    self.assertEqual(actual.read(), expected.read())
+
+        def save_with(out: io.StringIO, _options: Dict[str, Any]) -> None:
+            out.write("digraph tree {")
+            raise RuntimeError("failed")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            config.option["outputDir"] = tmp
+            with unittest.mock.patch.object(model, "save_with", save_with):
+                with self.assertRaises(RuntimeError):
+                    model.save_batch()
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_server(self) -> None:
+        """Test that the server renders from memory, caches the result and reloads changed inputs."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "screenshot.ged")
+            shutil.copy("screenshot.ged", path)
+            config = ged2dot.Config({'ged2dot': {'input': path, 'images': False, 'serverAddress': 'localhost:0'}})
+            render_server = ged2dot_server.RenderServer(config)
+            server = render_server.make_server()
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                connection = http.client.HTTPConnection(*cast(Tuple[str, int], server.server_address))
+
+                def get(url: str) -> Tuple[int, bytes]:
+                    connection.request("GET", url)
+                    response = connection.getresponse()
+                    return response.status, response.read()
+
+                status, body = get("/render?rootFamily=F1&layoutMaxDepth=3")
+                self.assertEqual(status, 200)
+                self.convert('screenshot', {'ged2dot': {'input': 'screenshot.ged', 'images': False, 'rootFamily': 'F1', 'layoutMaxDepth': 3}})
+                with open("screenshot.dot", "rb") as expected:
+                    self.assertEqual(body, expected.read())
+                self.assertEqual(get("/render?rootFamily=F1&layoutMaxDepth=3"), (200, body))
+                self.assertEqual(get("/render?imageFormat=x")[0], 400)
+                self.assertEqual(get("/render?rootFamily=F999")[0], 404)
+                # The depth option is restored after the request.
+                self.assertNotEqual(get("/render?rootFamily=F1")[1], body)
+
+                # Touching the input keeps the cache.
+                stat = os.stat(path)
+                os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+                self.assertEqual(get("/render?rootFamily=F1&layoutMaxDepth=3"), (200, body))
+                small = get("/render?rootFamily=F1&layoutMaxDepth=1")[1]
+
+                # Changing P158 only affects the larger chart.
+                with open(path, "r") as stream:
+                    content = stream.read()
+                with open(path, "w") as stream:
+                    stream.write(content.replace("1 NAME Philip /Smith/", "1 NAME Phil /Smith/"))
+                os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2000000000))
+                self.assertEqual(get("/render?rootFamily=F1&layoutMaxDepth=1"), (200, small))
+                status, changed = get("/render?rootFamily=F1&layoutMaxDepth=3")
+                self.assertNotEqual(changed, body)
+                self.assertIn(b"// Phil Smith", changed)
+
+                metrics = get("/metrics")[1].decode("utf-8").splitlines()
+                self.assertIn("ged2dot_requests_total 9", metrics)
+                self.assertIn("ged2dot_cache_hits_total 3", metrics)
+                self.assertIn("ged2dot_model_loads_total 1", metrics)
+                self.assertIn("ged2dot_model_reloads_total 2", metrics)
+                self.assertIn('ged2dot_model_individuals{input="%s"} 57' % path, metrics)
+
+                self.assertEqual(get("/render?layout=Svg")[0], 400)
+                self.assertEqual(get("/render?layout=Descendants")[0], 200)
+                connection.close()
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+            # Clients can lower the node budget of the server, but not raise or remove it.
+            config.option["layoutMaxNodes"] = 100
+            self.assertEqual(render_server.get_options({"layoutMaxNodes": ["50"]}), {"layoutMaxNodes": 50})
+            self.assertEqual(render_server.get_options({"layoutMaxNodes": ["1000"]}), {"layoutMaxNodes": 100})
+            self.assertEqual(render_server.get_options({"layoutMaxNodes": ["0"]}), {"layoutMaxNodes": 100})
+
+    def test_server_parse_error(self) -> None:
+        """Test that the server keeps running and reports errors while an input can't be parsed."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "screenshot.ged")
+            shutil.copy("screenshot.ged", path)
+            config = ged2dot.Config({'ged2dot': {'input': path, 'images': False, 'serverAddress': 'localhost:0'}})
+            render_server = ged2dot_server.RenderServer(config)
+            status, _, body = render_server.handle("/render?rootFamily=F1&layoutMaxDepth=3")
+            self.assertEqual(status, 200)
+            with open(path, "r") as stream:
+                content = stream.read()
+            stat = os.stat(path)
+
+            with open(path, "w") as stream:
+                stream.write(content.replace("1 SEX M", "1 SEX", 1))
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+            status, _, error = render_server.handle("/render?rootFamily=F1&layoutMaxDepth=3")
+            self.assertEqual(status, 500)
+            self.assertIn(b"line (13): 1 SEX", error)
+            # The previous model is kept, the input is parsed again on the next request.
+            self.assertEqual(render_server.handle("/render?rootFamily=F1&layoutMaxDepth=3")[0], 500)
+            self.assertEqual(len(render_server.models[path][3].individuals), 57)
+
+            with open(path, "w") as stream:
+                stream.write(content)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2000000000))
+            self.assertEqual(render_server.handle("/render?rootFamily=F1&layoutMaxDepth=3")[:3:2], (200, body))
+
+    def test_reload(self) -> None:
+        """Test that reloading a changed input only parses the changed records, with the same result as a load."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "screenshot.ged")
+            shutil.copy("screenshot.ged", path)
+            config = ged2dot.Config({'ged2dot': {'input': path, 'images': False, 'rootFamily': 'F1'}})
+            model = ged2dot.Model(config)
+            model.load(path)
+            model.track_changes(path)
+            self.assertEqual(model.reload(path), (set(), set()))
+
+            with open(path, "r") as stream:
+                content = stream.read()
+            content = content.replace("1 NAME Philip /Smith/", "1 NAME Phil /Smith/")
+            content = content.replace("0 TRLR", "0 @P999@ INDI\n1 NAME New /Smith/\n1 FAMC @F1@\n0 TRLR")
+            content = content.replace("0 @F1@ FAM \n", "0 @F1@ FAM \n1 CHIL @P999@\n")
+            with open(path, "w") as stream:
+                stream.write(content)
+            self.assertEqual(model.reload(path), ({"P158", "P999"}, {"F1"}))
+
+            fresh = ged2dot.Model(config)
+            fresh.load(path)
+            self.assertEqual([i.iid for i in model.individuals], [i.iid for i in fresh.individuals])
+            self.assertEqual([i.fid for i in model.families], [i.fid for i in fresh.families])
+            reloaded_out = io.StringIO()
+            model.save(reloaded_out)
+            fresh_out = io.StringIO()
+            fresh.save(fresh_out)
+            self.assertEqual(reloaded_out.getvalue(), fresh_out.getvalue())
+            self.assertIn("P999", fresh_out.getvalue())
+
+    def test_reload_parse_error(self) -> None:
+        """Test that a failed reload leaves the model as it was, so a partial fix reloads all changes."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "screenshot.ged")
+            shutil.copy("screenshot.ged", path)
+            config = ged2dot.Config({'ged2dot': {'input': path, 'images': False, 'rootFamily': 'F1'}})
+            model = ged2dot.Model(config)
+            model.load(path)
+            model.track_changes(path)
+
+            with open(path, "r") as stream:
+                content = stream.read()
+            content = content.replace("1 NAME Lesley /Johnson/", "1 NAME Les /Johnson/")
+            with open(path, "w") as stream:
+                stream.write(content.replace("1 SEX M", "1 SEX", 1))
+            with self.assertRaises(ged2dot.GedcomParseError):
+                model.reload(path)
+            self.assertEqual(len(model.individuals), 57)
+            individual = model.get_individual("P159")
+            assert individual
+            self.assertEqual(individual.forename, "Lesley")
+
+            # Only P158 is fixed, P159 is still renamed.
+            with open(path, "w") as stream:
+                stream.write(content)
+            self.assertEqual(model.reload(path), ({"P159"}, set()))
+            individual = model.get_individual("P159")
+            assert individual
+            self.assertEqual(individual.forename, "Les")
+            fresh = ged2dot.Model(config)
+            fresh.load(path)
+            self.assertEqual([i.iid for i in model.individuals], [i.iid for i in fresh.individuals])
+            reloaded_out = io.StringIO()
+            model.save(reloaded_out)
+            fresh_out = io.StringIO()
+            fresh.save(fresh_out)
+            self.assertEqual(reloaded_out.getvalue(), fresh_out.getvalue())
+
+    def test_reload_placeholders(self) -> None:
+        """Test that reloading doesn't keep the placeholders of replaced families."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "nohusb.ged")
+            shutil.copy("nohusb.ged", path)
+            config = ged2dot.Config({'ged2dot': {'input': path, 'rootFamily': 'F3'}})
+            model = ged2dot.Model(config)
+            model.load(path)
+            model.track_changes(path)
+            model.save(io.StringIO())
+            expected = sorted(i.iid for i in model.individuals)
+            for _ in range(3):
+                # Changes F1, which has a placeholder husband.
+                with open(path, "r") as stream:
+                    content = stream.read()
+                with open(path, "w") as stream:
+                    stream.write(content.replace("0 @F1@ FAM", "0 @F1@ FAM "))
+                self.assertEqual(model.reload(path), (set(), {"F1"}))
+                model.save(io.StringIO())
+                self.assertEqual(sorted(i.iid for i in model.individuals), expected)
+
+    def test_output_cache(self) -> None:
+        """Test that outputs are cached till a record they depend on changes."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "screenshot.ged")
+            shutil.copy("screenshot.ged", path)
+            config_dict = {'ged2dot': {'input': path, 'images': False, 'rootFamily': 'F1', 'layoutMaxDepth': 1,
+                                       'outputCacheDir': os.path.join(tmp, "cache")}}
+
+            def save() -> Tuple[str, ged2dot.Layout]:
+                config = ged2dot.Config(config_dict)
+                model = ged2dot.Model(config)
+                model.load(path)
+                out = io.StringIO()
+                layout = model.save(out)
+                return out.getvalue(), layout
+
+            # The key and the layout share the filtered families.
+            filter_families = ged2dot.Layout.filter_families
+            with unittest.mock.patch.object(ged2dot.Layout, "filter_families", autospec=True, side_effect=filter_families) as mock:
+                expected, layout = save()
+                self.assertEqual(mock.call_count, 1)
+            self.assertTrue(layout.subgraphs)
+            output, layout = save()
+            self.assertEqual(output, expected)
+            # Served from the cache, without building the layout.
+            self.assertFalse(layout.subgraphs)
+
+            # P158 is not shown with layoutMaxDepth = 1.
+            with open(path, "r") as stream:
+                content = stream.read()
+            with open(path, "w") as stream:
+                stream.write(content.replace("1 NAME Philip /Smith/", "1 NAME Phil /Smith/"))
+            output, layout = save()
+            self.assertEqual(output, expected)
+            self.assertFalse(layout.subgraphs)
+
+            config_dict['ged2dot']['layoutMaxDepth'] = 3
+            output, layout = save()
+            self.assertTrue(layout.subgraphs)
+            self.assertIn("// Phil Smith", output)
+
+    def test_output_cache_paths(self) -> None:
+        """Test that cached outputs are not shared by inputs given relative to different directories."""
+        with tempfile.TemporaryDirectory() as tmp:
+            def save(path: str) -> str:
+                config = ged2dot.Config({'ged2dot': {'input': path, 'rootFamily': 'F1', 'outputCacheDir': tmp}})
+                model = ged2dot.Model(config)
+                model.load(path)
+                out = io.StringIO()
+                model.save(out)
+                return out.getvalue()
+
+            self.assertIn('src="images/Ray Smith Y', save("screenshot.ged"))
+            cwd = os.getcwd()
+            os.chdir("..")
+            try:
+                self.assertIn('src="test/images/Ray Smith Y', save("test/screenshot.ged"))
+            finally:
+                os.chdir(cwd)
+
+    def test_output_cache_thumbnails(self) -> None:
+        """Test that a cached output marks the thumbnails it refers to as recently used."""
+        with tempfile.TemporaryDirectory() as tmp:
+            config_dict = {'ged2dot': {'input': 'screenshot.ged', 'rootFamily': 'F1', 'outputCacheDir': os.path.join(tmp, "output"),
+                                       'thumbnailCacheDir': os.path.join(tmp, "thumbnails")}}
+
+            def save() -> Tuple[List[str], ged2dot.Layout]:
+                config = ged2dot.Config(config_dict)
+                model = ged2dot.Model(config)
+                model.load(config.input)
+                get_picture = ged2dot.ThumbnailCache.get_picture
+                with unittest.mock.patch.object(ged2dot.ThumbnailCache, "get_picture", autospec=True, side_effect=get_picture) as mock:
+                    layout = model.save(io.StringIO())
+                return [i[0][1] for i in mock.call_args_list], layout
+
+            pictures, layout = save()
+            self.assertTrue(layout.subgraphs)
+            cached_pictures, layout = save()
+            self.assertFalse(layout.subgraphs)
+            self.assertTrue(set(pictures).issubset(set(cached_pictures)))
+            self.assertIn(os.path.join("images", "Ray Smith Y.jpg"), cached_pictures)
+
+    def test_pedigree_collapse(self) -> None:
+        """Test that a family reached on multiple paths is only visited once.
+        Without that, each generation doubled the number of visited families."""
+        generations = 40
+        lines = ["0 HEAD", "1 CHAR UTF-8"]
+        for i in range(1, generations + 1):
+            famc = "1 FAMC @F%s@" % (i + 1) if i < generations else ""
+            for iid, sex in (("P%sH" % i, "M"), ("P%sW" % i, "F")):
+                lines += ["0 @%s@ INDI" % iid, "1 NAME %s /Test/" % iid, "1 SEX %s" % sex, famc, "1 FAMS @F%s@" % i]
+            lines += ["0 @F%s@ FAM" % i, "1 HUSB @P%sH@" % i, "1 WIFE @P%sW@" % i]
+            if i > 1:
+                lines += ["1 CHIL @P%sH@" % (i - 1), "1 CHIL @P%sW@" % (i - 1)]
+        lines.append("0 TRLR")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "collapse.ged")
+            with open(path, "w") as stream:
+                stream.write("\n".join(line for line in lines if line) + "\n")
+            config = ged2dot.Config({'ged2dot': {'input': path, 'rootFamily': 'F1', 'layoutMaxDepth': generations}})
+            model = ged2dot.Model(config)
+            model.load(config.input)
+            layout = ged2dot.Layout(model, io.StringIO())
+            layout.calc()
+            self.assertEqual(len(layout.filtered_families), generations)
+            self.assertEqual([f.depth for f in layout.filtered_families], list(range(generations)))
+
+    def test_child_order_birth(self) -> None:
+        """Test that siblings are ordered by birth, but the shown wife / husb stays leftmost / rightmost."""
+        config = ged2dot.Config({'ged2dot': {'childOrderBirth': True}})
+        model = ged2dot.Model(config)
+        family = ged2dot.Family(model)
+        family.fid = "F1"
+        shown = ged2dot.Family(model)
+        shown.fid = "F2"
+        for iid, sex, birt in (("P1", "M", "1952"), ("P2", "F", "1950"), ("P3", "M", ""), ("P4", "F", "1948")):
+            individual = ged2dot.Individual(model)
+            individual.iid = iid
+            individual.sex = sex
+            individual.birt = birt
+            model.add_individual(individual)
+            family.chil.append(iid)
+        husb = model.get_individual("P1")
+        assert husb
+        husb.fams = shown
+        family.sort_children({shown: None})
+        self.assertEqual(family.chil, ["P4", "P2", "P3", "P1"])
+
+    def test_subgraph_index(self) -> None:
+        """Test that prepend/insert keep the element order and the lookups in sync."""
+        config = ged2dot.Config({'ged2dot': {'input': 'screenshot.ged', 'rootFamily': 'F1'}})
+        model = ged2dot.Model(config)
+        model.load(config.input)
+        subgraph = ged2dot.Subgraph("Depth0", model)
+        first = ged2dot.Node("P1")
+        second = ged2dot.Node("P2")
+        subgraph.append(second)
+        subgraph.prepend(first)
+        edge = ged2dot.Edge(model, "P1", "P2")
+        subgraph.append(edge)
+        middle = ged2dot.Node("P3")
+        subgraph.insert_before(second, middle)
+        self.assertEqual(subgraph.elements, (first, middle, second, edge))
+        self.assertLess(subgraph.get_position(first), subgraph.get_position(middle))
+        self.assertLess(subgraph.get_position(middle), subgraph.get_position(second))
+        # Inserting many times at the same place renumbers the positions.
+        inserted = [ged2dot.Node("P%s" % i) for i in range(100, 200)]
+        for node in inserted:
+            subgraph.insert_before(second, node)
+        self.assertEqual(subgraph.elements, tuple([first, middle] + inserted + [second, edge]))
+        positions = [subgraph.get_position(i) for i in subgraph.elements]
+        self.assertEqual(positions, sorted(set(positions)))
+        subgraph.move_edges_to("P2", "P3")
+        self.assertEqual(edge.to_node, "P3")
+        self.assertEqual(subgraph.edges_to["P3"], [edge])
+        self.assertNotIn("P2", subgraph.edges_to)
+
 
 if __name__ == '__main__':
     unittest.main()